@@ -0,0 +1,137 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Frame-to-frame drift estimation for stacks. Scale is found by phase correlation of the log-polar
+# magnitude spectra (Fourier-Mellin), translation by phase correlation once scale is compensated.
+# Everything runs on a downsampled grayscale copy so it keeps up with the capture loop.
+
+from PIL import Image
+import json
+import numpy as np
+import os
+from raw_preview import open_image
+
+ALIGNMENT_SIZE = 512  # Longest side of the copy the alignment runs on
+ALIGNMENT_FILE = "alignment.json"
+DRIFT_LIMIT = 0.02  # Shift between consecutive frames, as a fraction of the width, considered a bump
+SCALE_LIMIT = 0.05  # Relative scale change between consecutive frames considered a bump
+
+def load_alignment_image(image_path, size=ALIGNMENT_SIZE):
+    image = open_image(image_path, (size, size))
+    full_width = image.width
+    image.draft("L", (size, size))
+    image = image.convert("L")
+    image.thumbnail((size, size))
+    return np.asarray(image, dtype=np.float32), full_width
+
+def hanning_window(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1])).astype(np.float32)
+
+def subpixel_offset(before, peak, after):
+    # Vertex of the parabola through three samples around a peak
+    denominator = before - 2 * peak + after
+    if denominator == 0:
+        return 0.0
+    return 0.5 * (before - after) / denominator
+
+def phase_correlation(reference, moving):
+    # Returns (dy, dx, response) such that moving is reference shifted by (dy, dx)
+    cross = np.fft.fft2(moving) * np.conj(np.fft.fft2(reference))
+    cross /= np.abs(cross) + 1e-12
+    correlation = np.fft.ifft2(cross).real
+    height, width = correlation.shape
+    y, x = np.unravel_index(np.argmax(correlation), correlation.shape)
+    peak = correlation[y, x]
+    dy = y + subpixel_offset(correlation[y - 1, x], peak, correlation[(y + 1) % height, x])
+    dx = x + subpixel_offset(correlation[y, x - 1], peak, correlation[y, (x + 1) % width])
+    if dy > height / 2:
+        dy -= height
+    if dx > width / 2:
+        dx -= width
+    return dy, dx, float(peak)
+
+def log_polar_magnitude(image, window):
+    spectrum = np.abs(np.fft.fftshift(np.fft.fft2(image * window)))
+    height, width = spectrum.shape
+    fy = np.linspace(-0.5, 0.5, height, endpoint=False)[:, None]
+    fx = np.linspace(-0.5, 0.5, width, endpoint=False)[None, :]
+    spectrum *= 1 - np.cos(np.pi * fy) * np.cos(np.pi * fx)  # High-pass, low frequencies say little about scale
+    radius_count = angle_count = min(height, width)
+    max_radius = min(height, width) / 2
+    log_base = np.exp(np.log(max_radius) / radius_count)
+    radii = log_base ** np.arange(radius_count)
+    angles = np.linspace(0, np.pi, angle_count, endpoint=False)  # The magnitude spectrum is symmetric
+    ys = height / 2 + radii[None, :] * np.sin(angles[:, None])
+    xs = width / 2 + radii[None, :] * np.cos(angles[:, None])
+    y0 = np.clip(np.floor(ys).astype(int), 0, height - 2)
+    x0 = np.clip(np.floor(xs).astype(int), 0, width - 2)
+    wy, wx = ys - y0, xs - x0
+    polar = (
+        spectrum[y0, x0] * (1 - wy) * (1 - wx) + spectrum[y0 + 1, x0] * wy * (1 - wx)
+        + spectrum[y0, x0 + 1] * (1 - wy) * wx + spectrum[y0 + 1, x0 + 1] * wy * wx
+    )
+    return np.log1p(polar).astype(np.float32), log_base
+
+def rescale(image, scale):
+    # Scales the image about its centre, keeping its size
+    height, width = image.shape
+    inverse = 1 / scale
+    matrix = (inverse, 0, width / 2 * (1 - inverse), 0, inverse, height / 2 * (1 - inverse))
+    return np.asarray(Image.fromarray(image).transform((width, height), Image.AFFINE, matrix, Image.BILINEAR))
+
+def estimate_transform(reference, moving):
+    # Returns (scale, dy, dx, response) of moving relative to reference, in pixels of the given arrays
+    window = hanning_window(reference.shape)
+    reference_polar, log_base = log_polar_magnitude(reference, window)
+    moving_polar, _ = log_polar_magnitude(moving, window)
+    _, radius_shift, _ = phase_correlation(reference_polar, moving_polar)
+    scale = float(log_base ** -radius_shift)
+    unscaled = rescale(moving, 1 / scale)
+    dy, dx, response = phase_correlation(reference * window, unscaled * window)
+    return scale, float(dy), float(dx), response
+
+class StackAligner:
+    # Aligns each new frame of a stack against the previous one and keeps the cumulative transforms in a sidecar
+    def __init__(self, folder):
+        self.folder = folder
+        self.previous = None
+        self.frames = []
+        self.cumulative = {"scale": 1.0, "dx": 0.0, "dy": 0.0}
+
+    def add_frame(self, image_path):
+        # Returns the entry recorded for the frame, with "drift" set when the move looks like a bump
+        image, full_width = load_alignment_image(image_path)
+        entry = {"file": os.path.basename(image_path), "scale": 1.0, "dx": 0.0, "dy": 0.0, "response": 1.0, "drift": False}
+        if self.previous is not None and self.previous.shape == image.shape:
+            scale, dy, dx, response = estimate_transform(self.previous, image)
+            factor = full_width / image.shape[1]  # Report shifts in full-resolution pixels
+            entry.update(scale=scale, dx=dx * factor, dy=dy * factor, response=response)
+            self.cumulative["scale"] *= scale
+            self.cumulative["dx"] += dx * factor
+            self.cumulative["dy"] += dy * factor
+            entry["drift"] = bool(np.hypot(dx, dy) > DRIFT_LIMIT * image.shape[1] or abs(scale - 1) > SCALE_LIMIT)
+        entry["cumulative"] = dict(self.cumulative)
+        self.previous = image
+        self.frames.append(entry)
+        self.save()
+        return entry
+
+    def save(self):
+        sidecar = os.path.join(self.folder, ALIGNMENT_FILE)
+        with open(sidecar + ".tmp", "w") as file:
+            json.dump({"frames": self.frames}, file, indent=2)
+        os.replace(sidecar + ".tmp", sidecar)
@@ -0,0 +1,157 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# End-to-end stack cycle benchmark against the simulated camera and stepper. Each scenario runs the same
+# job as the Capture Stack button and reports throughput, trigger-to-saved latency and the time a
+# simulated UI thread spends blocked handling the new frames.
+
+import argparse
+import json
+import numpy as np
+import os
+import queue
+import tempfile
+import threading
+import time
+from engine import Engine, STEPPER_RPM
+from image_cache import decode_rendition
+from simulator import FakeCamera, fake_stepper
+from thumbnail_cache import THUMBNAIL_SIZE
+from tracing import tracer
+
+UI_TICK = 1 / 60  # A UI callback taking longer than one frame at 60 Hz is felt as a stall
+DISPLAY_SIZE = (1280, 800)
+
+class SimulatedUi:
+    # Does the work the GUI does for every downloaded frame. on_frame_downloaded decodes the canvas rendition and
+    # the tree thumbnail on the engine's download thread, as the GUI does. The UI thread then only turns them into
+    # Tk images, and only that work counts as stall.
+    def __init__(self):
+        self.frames = queue.Queue()
+        self.tick_times = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            start = time.perf_counter()
+            while True:
+                try:
+                    target, rendition, thumbnail = self.frames.get_nowait()
+                except queue.Empty:
+                    break
+                with tracer.span("display", file=os.path.basename(target)):
+                    # ImageTk.PhotoImage copies the pixels into Tk, the same copy as tobytes
+                    rendition.tobytes()
+                    thumbnail.tobytes()
+            self.tick_times.append(time.perf_counter() - start)
+            time.sleep(UI_TICK)
+
+    def on_frame_downloaded(self, folder, target, data):
+        with tracer.span("display decode", file=os.path.basename(target)):
+            rendition = decode_rendition(data, target, DISPLAY_SIZE)
+        thumbnail = rendition.copy()
+        thumbnail.thumbnail(THUMBNAIL_SIZE)
+        self.frames.put((target, rendition, thumbnail))
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def stall_time(self):
+        return sum(max(0, tick - UI_TICK) for tick in self.tick_times)
+
+def run_scenario(name, job, camera_options, rpm=STEPPER_RPM):
+    with tempfile.TemporaryDirectory() as capture_folder:
+        camera = FakeCamera(**camera_options)
+        engine = Engine(camera=camera, capture_folder=capture_folder)
+        engine.stepper = fake_stepper(rpm)
+        ui = SimulatedUi()
+        latencies = []
+
+        def on_frame_saved(folder, target):
+            latencies.append(time.time() - camera.trigger_times[os.path.basename(target)])
+
+        engine.download_listeners.append(ui.on_frame_downloaded)
+        engine.frame_listeners.append(on_frame_saved)
+        start = time.time()
+        engine.run_stack(dict(job))
+        elapsed = time.time() - start
+        while not ui.frames.empty():
+            time.sleep(UI_TICK)
+        ui.stop()
+        engine.disconnect_stepper()
+    saved = len(latencies)
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        "scenario": name,
+        "frames": saved,
+        "seconds": elapsed,
+        "frames_per_minute": saved / elapsed * 60,
+        "latency_p50": float(np.percentile(latencies, 50)),
+        "latency_p90": float(np.percentile(latencies, 90)),
+        "latency_p99": float(np.percentile(latencies, 99)),
+        "ui_stall": ui.stall_time(),
+        "ui_max_tick": max(ui.tick_times, default=0),
+    }
+
+def print_report(results):
+    print(f"{'scenario':<14}{'frames':>7}{'seconds':>9}{'fpm':>8}{'p50 s':>8}{'p90 s':>8}{'p99 s':>8}{'stall s':>9}{'max tick s':>11}")
+    for result in results:
+        print(
+            f"{result['scenario']:<14}{result['frames']:>7}{result['seconds']:>9.2f}{result['frames_per_minute']:>8.1f}"
+            f"{result['latency_p50']:>8.2f}{result['latency_p90']:>8.2f}{result['latency_p99']:>8.2f}"
+            f"{result['ui_stall']:>9.2f}{result['ui_max_tick']:>11.3f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stack capture cycle against simulated hardware")
+    parser.add_argument("--frames", type=int, default=20)
+    parser.add_argument("--angle", type=int, default=30)
+    parser.add_argument("--delay", type=float, default=0.5, help="Pre-shot delay in seconds")
+    parser.add_argument("--format", choices=("jpeg", "raw"), default="jpeg")
+    parser.add_argument("--size", default="3000x2000", help="Frame size as WIDTHxHEIGHT")
+    parser.add_argument("--raw-megabytes", type=int, default=25)
+    parser.add_argument("--capture-latency", type=float, default=0.25)
+    parser.add_argument("--usb-mbps", type=float, default=30, help="Camera to host throughput in MB/s")
+    parser.add_argument("--modes", default="sequential,pipelined,burst,settle")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args()
+
+    width, height = (int(value) for value in args.size.split("x"))
+    camera_options = {
+        "image_format": args.format,
+        "size": (width, height),
+        "raw_megabytes": args.raw_megabytes,
+        "capture_latency": args.capture_latency,
+        "usb_megabytes_per_second": args.usb_mbps,
+    }
+    results = []
+    for mode in args.modes.split(","):
+        job = {
+            "frames": args.frames, "angle": args.angle, "delay": args.delay, "folder": "Bench",
+            "pipelined": mode in ("pipelined", "settle"), "burst": mode == "burst", "settle": mode == "settle",
+        }
+        results.append(run_scenario(mode, job, camera_options))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+import gphoto2 as gp
+import queue
+import threading
+import time
+from tracing import tracer
+
+CAMERA_SETTINGS = ('iso', 'shutterspeed', 'whitebalance', 'imageformat')
+COALESCE_DELAY = 0.15  # Seconds to wait for further changes before writing to the camera
+EVENT_POLL_INTERVAL = 2  # Seconds between checks for changes made on the camera body
+
+class CameraSettings:
+    # Cached copy of the camera settings. Changes are queued, coalesced and written on a worker
+    # thread, one widget at a time where the camera driver supports it. Camera events are not read while
+    # the busy event is set, as draining them would drop the file added events captures wait for.
+    def __init__(self, camera, camera_lock, names=CAMERA_SETTINGS, busy=None):
+        self.camera = camera
+        self.camera_lock = camera_lock
+        self.busy = busy or threading.Event()
+        self.names = names
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.changes = queue.Queue()  # Names whose cached value changed on the camera side
+        self.single_config = hasattr(gp, "gp_camera_set_single_config")
+        self.values = {}
+        self.choices = {}
+        with self.camera_lock:
+            self.refresh()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def refresh(self):
+        # Reads the whole tree once and caches the widgets the GUI uses, caller holds the camera lock
+        self.config = gp.check_result(gp.gp_camera_get_config(self.camera))
+        self.widgets = {}
+        for name in self.names:
+            OK, widget = gp.gp_widget_get_child_by_name(self.config, name)
+            if OK >= gp.GP_OK:
+                self.widgets[name] = widget
+                self.values[name] = gp.check_result(gp.gp_widget_get_value(widget))
+                self.choices[name] = [gp.check_result(gp.gp_widget_get_choice(widget, i)) for i in range(gp.gp_widget_count_choices(widget))]
+
+    def get(self, name):
+        return self.values.get(name), self.choices.get(name, [])
+
+    def set(self, name, value):
+        with self.pending_lock:
+            self.pending[name] = value
+        self.wake.set()
+
+    def run(self):
+        last_poll = time.time()
+        while True:
+            if self.wake.wait(timeout=EVENT_POLL_INTERVAL):
+                time.sleep(COALESCE_DELAY)  # Let rapid changes pile up into one transaction
+                self.wake.clear()
+                with self.pending_lock:
+                    pending, self.pending = self.pending, {}
+                self.write(pending)
+            elif time.time() - last_poll >= EVENT_POLL_INTERVAL:
+                last_poll = time.time()
+                self.poll_events()
+
+    def write(self, pending):
+        changed = {name: value for name, value in pending.items() if name in self.widgets and self.values.get(name) != value}
+        if not changed:
+            return
+        try:
+            with self.camera_lock, tracer.span("write", category="config", names=list(changed)):
+                for name, value in changed.items():
+                    gp.check_result(gp.gp_widget_set_value(self.widgets[name], value))
+                if self.single_config:
+                    try:
+                        for name in changed:
+                            gp.check_result(gp.gp_camera_set_single_config(self.camera, name, self.widgets[name]))
+                    except gp.GPhoto2Error as e:
+                        if e.code != gp.GP_ERROR_NOT_SUPPORTED:
+                            raise
+                        self.single_config = False
+                if not self.single_config:
+                    # The cached tree may hold stale values of widgets changed elsewhere, such as capturetarget
+                    # during a burst, so it is read again and only the changed widgets are set before writing it
+                    previous = dict(self.values)
+                    self.refresh()
+                    for name in self.names:
+                        if name not in changed and self.values.get(name) != previous.get(name):
+                            self.changes.put(name)
+                    for name, value in changed.items():
+                        gp.check_result(gp.gp_widget_set_value(self.widgets[name], value))
+                    gp.check_result(gp.gp_camera_set_config(self.camera, self.config))
+            self.values.update(changed)
+            print(f"Camera settings written: {changed}")
+        except gp.GPhoto2Error as e:
+            print(f"Failed to set {', '.join(changed)}: {e}")
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+
+    def poll_events(self):
+        # Settings changed on the camera body are only re-read when the camera says so
+        if self.busy.is_set():
+            return  # Stack in progress, check again once it is over
+        if not self.camera_lock.acquire(blocking=False):
+            return  # Capture or preview in progress, check again later
+        try:
+            changed = False
+            while True:
+                event_type, event_data = gp.check_result(gp.gp_camera_wait_for_event(self.camera, 10))
+                if event_type == gp.GP_EVENT_TIMEOUT:
+                    break
+                if event_type == gp.GP_EVENT_UNKNOWN and "changed" in str(event_data):
+                    changed = True
+            if changed:
+                previous = dict(self.values)
+                self.refresh()
+                for name in self.names:
+                    if self.values.get(name) != previous.get(name):
+                        self.changes.put(name)
+        except gp.GPhoto2Error as e:
+            print(f"Failed to read camera events: {e}")
+        finally:
+            self.camera_lock.release()
@@ -0,0 +1,172 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Persistent index of the capture library. Saved frames are added as they are written and stack runs
+# record their settings, so opening the library is a query instead of a walk. reconcile() catches
+# changes made outside the application by rescanning only the folders whose mtime changed.
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from image_cache import IMAGE_EXTENSIONS
+
+CATALOG_FILE = ".catalog.sqlite"
+
+def folder_label(folder_path):
+    # Name shown in the tree, frames saved to a nested Capture folder are shown under its parent
+    label = os.path.basename(folder_path)
+    if label == "Capture":
+        label = os.path.basename(os.path.dirname(folder_path))
+    return label
+
+class Catalog:
+    def __init__(self, root, db_path=None):
+        self.root = os.path.normpath(root)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path or os.path.join(root, CATALOG_FILE), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS folders (path TEXT PRIMARY KEY, parent TEXT, label TEXT, mtime REAL);"
+            "CREATE TABLE IF NOT EXISTS images (path TEXT PRIMARY KEY, folder TEXT, file_size INTEGER, mtime REAL, added REAL);"
+            "CREATE TABLE IF NOT EXISTS stacks (folder TEXT PRIMARY KEY, started REAL, finished REAL, frames INTEGER,"
+            " angle INTEGER, delay REAL, settings TEXT);"
+            "CREATE INDEX IF NOT EXISTS images_folder ON images (folder);"
+            "CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);"
+            "CREATE INDEX IF NOT EXISTS folders_label ON folders (label);"
+        )
+        self.db.commit()
+
+    def add_folder(self, folder_path):
+        # A folder first seen here has no mtime, so the next reconcile lists it once
+        folder_path = os.path.normpath(folder_path)
+        while folder_path != self.root and folder_path.startswith(self.root + os.sep):
+            self.db.execute(
+                "INSERT OR IGNORE INTO folders VALUES (?, ?, ?, NULL)",
+                (folder_path, os.path.dirname(folder_path), folder_label(folder_path)),
+            )
+            folder_path = os.path.dirname(folder_path)
+
+    def add_image(self, image_path):
+        image_path = os.path.normpath(image_path)
+        stat = os.stat(image_path)
+        with self.lock:
+            self.add_folder(os.path.dirname(image_path))
+            self.db.execute(
+                "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)",
+                (image_path, os.path.dirname(image_path), stat.st_size, stat.st_mtime, time.time()),
+            )
+            self.db.commit()
+
+    def begin_stack(self, folder, job):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO stacks VALUES (?, ?, NULL, 0, ?, ?, ?)",
+                (folder, time.time(), int(job["angle"]), float(job.get("delay", 1)), json.dumps(job.get("settings", {}))),
+            )
+            self.db.commit()
+
+    def end_stack(self, folder, frames):
+        with self.lock:
+            self.db.execute("UPDATE stacks SET finished = ?, frames = ? WHERE folder = ?", (time.time(), frames, folder))
+            self.db.commit()
+
+    def stack(self, folder):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT folder, started, finished, frames, angle, delay, settings FROM stacks WHERE folder = ?", (folder,)
+            ).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("folder", "started", "finished", "frames", "angle", "delay"), row[:6]), settings=json.loads(row[6] or "{}"))
+
+    def reconcile(self):
+        # Unchanged folders cost one stat, their files and subfolders are taken from the catalog. The lock is
+        # taken per folder, so frames being saved and queries from the UI are not held up by a whole walk.
+        pending = [self.root]
+        while pending:
+            folder_path = pending.pop()
+            with self.lock:
+                pending.extend(self.reconcile_folder(folder_path))
+                self.db.commit()
+
+    def reconcile_folder(self, folder_path):
+        try:
+            mtime = os.stat(folder_path).st_mtime
+        except OSError:
+            self.forget_folder(folder_path)
+            return []
+        row = self.db.execute("SELECT mtime FROM folders WHERE path = ?", (folder_path,)).fetchone()
+        if row is not None and row[0] == mtime:
+            return [path for (path,) in self.db.execute("SELECT path FROM folders WHERE parent = ?", (folder_path,))]
+        subfolders = []
+        images = {}
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if entry.name.startswith("."):
+                    continue
+                if entry.is_dir():
+                    subfolders.append(os.path.normpath(entry.path))
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    images[os.path.normpath(entry.path)] = entry.stat()
+        known = {
+            path: (file_size, mtime)
+            for path, file_size, mtime in self.db.execute("SELECT path, file_size, mtime FROM images WHERE folder = ?", (folder_path,))
+        }
+        self.db.executemany("DELETE FROM images WHERE path = ?", [(path,) for path in known.keys() - images.keys()])
+        # New files, and files rewritten in place since they were recorded
+        self.db.executemany(
+            "INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?)",
+            [
+                (path, folder_path, stat.st_size, stat.st_mtime, stat.st_mtime)
+                for path, stat in images.items() if known.get(path) != (stat.st_size, stat.st_mtime)
+            ],
+        )
+        for (path,) in self.db.execute("SELECT path FROM folders WHERE parent = ?", (folder_path,)).fetchall():
+            if path not in subfolders:
+                self.forget_folder(path)
+        if folder_path != self.root:
+            self.db.execute(
+                "INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)",
+                (folder_path, os.path.dirname(folder_path), folder_label(folder_path), mtime),
+            )
+        else:
+            self.db.execute("INSERT OR REPLACE INTO folders VALUES (?, NULL, '', ?)", (folder_path, mtime))
+        for path in subfolders:
+            self.db.execute(
+                "INSERT OR IGNORE INTO folders VALUES (?, ?, ?, NULL)", (path, folder_path, folder_label(path))
+            )
+        return subfolders
+
+    def forget_folder(self, folder_path):
+        prefix = folder_path + os.sep
+        self.db.execute("DELETE FROM images WHERE folder = ? OR substr(folder, 1, ?) = ?", (folder_path, len(prefix), prefix))
+        self.db.execute("DELETE FROM folders WHERE path = ? OR substr(path, 1, ?) = ?", (folder_path, len(prefix), prefix))
+
+    def folder_images(self, pattern=""):
+        # Folder label -> sorted image paths, labels containing pattern only
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT folders.label, images.path FROM images JOIN folders ON folders.path = images.folder"
+                " WHERE folders.label != '' AND folders.label LIKE ? ORDER BY images.path",
+                (f"%{pattern}%",),
+            ).fetchall()
+        folder_dict = {}
+        for label, image_path in rows:
+            folder_dict.setdefault(label, []).append(image_path)
+        return folder_dict
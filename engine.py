@@ -0,0 +1,618 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Camera, stepper and stack-run control without any GUI. The Tk application and the command line
+# job runner below are both clients of Engine.
+
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import glob
+import json
+import os
+import queue
+import serial
+import gphoto2 as gp
+import subprocess
+import threading
+import time
+from catalog import Catalog
+from image_cache import decode_preview
+import focus_planning
+import settling
+import stacking
+from tracing import tracer
+
+CAPTURE_FOLDER = "Capture"
+STEPPER_RPM = 30  # Must match MOTOR_X_RPM in stepper_firmware.ino
+MOVE_TIMEOUT_MARGIN = 2  # Extra seconds to wait for a move acknowledgement before giving up
+SWEEP_SETTLE = 0.3  # Seconds to let the stage settle before sampling the preview during a sweep
+SWEEP_PREVIEW_SIZE = (320, 320)
+STEPPER_IDENTITY = b"MICROSTACKING"  # Answer of stepper_firmware.ino to the I command
+SERIAL_PATTERNS = ("/dev/ttyUSB*", "/dev/ttyACM*")  # USB serial adapters, where an Arduino shows up
+IDENTIFY_TIMEOUT = 3  # Seconds, opening the port resets the Arduino and its bootloader takes up to 2 seconds
+TRANSFER_WRITERS = 4  # Files written at once during the transfer at the end of a burst
+TRANSFER_PENDING = 2 * TRANSFER_WRITERS  # Downloaded frames held in memory waiting for a writer
+
+def list_cameras():
+    # (model, port) of every camera gphoto2 detects, the port being like usb:001,005
+    return [tuple(entry) for entry in gp.check_result(gp.gp_camera_autodetect())]
+
+class Camera:
+    # gphoto2 camera whose calls are serialized with a lock, so capture, download and preview can run on different threads.
+    # With a port, that camera is opened instead of the first one found.
+    def __init__(self, port=None):
+        self.port = port
+        self.camera = None
+        self.connected = False
+        self.lock = threading.Lock()
+
+    def connect(self):
+        subprocess.call(["gio", "mount", "-s", "gphoto2"])  # Release the camera if the desktop mounted it
+        try:
+            self.camera = gp.check_result(gp.gp_camera_new())
+            if self.port:
+                port_info_list = gp.check_result(gp.gp_port_info_list_new())
+                gp.check_result(gp.gp_port_info_list_load(port_info_list))
+                index = gp.check_result(gp.gp_port_info_list_lookup_path(port_info_list, self.port))
+                gp.check_result(gp.gp_camera_set_port_info(self.camera, gp.check_result(gp.gp_port_info_list_get_info(port_info_list, index))))
+            gp.check_result(gp.gp_camera_init(self.camera))
+            gp.gp_camera_capture_preview(self.camera)
+            self.connected = True
+        except gp.GPhoto2Error as e:
+            print(f"Failed to initialize camera: {e}")
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+        return self.connected
+
+    def serial_number(self):
+        with self.lock:
+            config = gp.check_result(gp.gp_camera_get_config(self.camera))
+            OK, widget = gp.gp_widget_get_child_by_name(config, "serialnumber")
+            if OK < gp.GP_OK:
+                return None
+            return gp.check_result(gp.gp_widget_get_value(widget))
+
+    def close(self):
+        if self.connected:
+            with self.lock:
+                gp.gp_camera_exit(self.camera)
+            self.connected = False
+
+    def capture(self):
+        print("Capturing image")
+        start_time = time.time()
+        with self.lock, tracer.span("capture"):
+            file_path = gp.check_result(gp.gp_camera_capture(self.camera, gp.GP_CAPTURE_IMAGE))
+        end_time = time.time()
+        print(f"Time taken to capture image: {end_time - start_time} seconds")
+        return file_path
+
+    def download(self, file_path):
+        # Returns the file contents as a view of the gphoto2 buffer, written and decoded without a copy
+        with self.lock, tracer.span("download", file=file_path.name):
+            camera_file = gp.check_result(gp.gp_camera_file_get(self.camera, file_path.folder, file_path.name, gp.GP_FILE_TYPE_NORMAL))
+            return memoryview(gp.check_result(gp.gp_file_get_data_and_size(camera_file)))
+
+    def file_size(self, file_path):
+        with self.lock:
+            info = gp.check_result(gp.gp_camera_file_get_info(self.camera, file_path.folder, file_path.name))
+        return info.file.size
+
+    def delete(self, file_path):
+        with self.lock:
+            gp.check_result(gp.gp_camera_file_delete(self.camera, file_path.folder, file_path.name))
+
+    def set_config(self, name, value):
+        # Sets one widget to the first choice containing value, returns the previous value
+        with self.lock, tracer.span("write", category="config", names=[name]):
+            config = gp.check_result(gp.gp_camera_get_config(self.camera))
+            widget = gp.check_result(gp.gp_widget_get_child_by_name(config, name))
+            previous = gp.check_result(gp.gp_widget_get_value(widget))
+            choices = [gp.check_result(gp.gp_widget_get_choice(widget, i)) for i in range(gp.gp_widget_count_choices(widget))]
+            matches = [choice for choice in choices if value.lower() in choice.lower()]
+            if not matches:
+                raise ValueError(f"{name} has no choice matching {value}: {choices}")
+            gp.check_result(gp.gp_widget_set_value(widget, matches[0]))
+            gp.check_result(gp.gp_camera_set_config(self.camera, config))
+        return previous
+
+    def capture_preview(self):
+        with self.lock, tracer.span("capture", category="preview"):
+            camera_file = gp.check_result(gp.gp_camera_capture_preview(self.camera))
+        return bytes(gp.check_result(gp.gp_file_get_data_and_size(camera_file)))
+
+class StepperChannel:
+    # Serial link to the stepper firmware, which answers "OK" once each U/D move has completed.
+    # An already open port-like object can be passed instead of a tty, as the simulator does.
+    def __init__(self, tty, baudrate, port=None):
+        self.tty = tty
+        self.serial = port or serial.Serial(tty, baudrate, timeout=0.1)
+        self.acks = queue.Queue()
+        self.identified = threading.Event()
+        self.reader = threading.Thread(target=self.read_lines, daemon=True)
+        self.reader.start()
+
+    @property
+    def is_open(self):
+        return self.serial.is_open
+
+    def read_lines(self):
+        while self.serial.is_open:
+            try:
+                line = self.serial.readline()
+            except (serial.SerialException, TypeError, OSError):
+                break
+            if line.strip() == b"OK":
+                self.acks.put(time.time())
+            elif line.strip() == STEPPER_IDENTITY:
+                self.identified.set()
+
+    def send(self, command):
+        self.serial.write(command.encode())
+
+    def move(self, command, timeout=None):
+        # Blocks until the firmware reports the move as finished, returns False on timeout
+        if timeout is None:
+            angle = abs(int(command[1:]))
+            timeout = angle / 360 * 60 / STEPPER_RPM + MOVE_TIMEOUT_MARGIN
+        while not self.acks.empty():  # Drop acknowledgements left over from manual moves
+            self.acks.get_nowait()
+        self.send(command)
+        try:
+            with tracer.span("move", command=command):
+                self.acks.get(timeout=timeout)
+            return True
+        except queue.Empty:
+            print(f"No acknowledgement for {command} after {timeout:.1f} seconds")
+            return False
+
+    def identify(self, timeout=IDENTIFY_TIMEOUT):
+        # Asks until the firmware answers, as the first requests are lost while the board resets
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self.send("I")
+            if self.identified.wait(0.25):
+                return True
+        return False
+
+    def close(self):
+        self.serial.close()
+
+def serial_candidates():
+    return sorted(tty for pattern in SERIAL_PATTERNS for tty in glob.glob(pattern))
+
+def find_stepper(baudrate, candidates=None):
+    # Probes every USB serial port at once and returns the open channel of the first one running the firmware
+    found = queue.Queue()
+
+    def probe(tty):
+        try:
+            channel = StepperChannel(tty, baudrate)
+        except (serial.SerialException, OSError) as e:
+            print(f"Failed to open {tty}: {e}")
+            return
+        if channel.identify():
+            found.put(channel)
+        else:
+            channel.close()
+
+    threads = [threading.Thread(target=probe, args=(tty,), daemon=True) for tty in (serial_candidates() if candidates is None else candidates)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    channels = []
+    while not found.empty():
+        channels.append(found.get_nowait())
+    for channel in channels[1:]:
+        channel.close()
+    return channels[0] if channels else None
+
+def write_frame(target, data):
+    with tracer.span("save", file=os.path.basename(target)), open(target, "wb") as file:
+        file.write(data)
+
+def new_stack_folder(rig=None):
+    # Rigs started in the same second get different folders
+    folder = f"Stack_{time.strftime('%Y%m%d_%H%M%S')}"
+    return f"{rig}_{folder}" if rig else folder
+
+class Engine:
+    # Frames are downloaded by a worker thread, so the stage can move while the previous frame is transferred,
+    # and written to disk by another. download_listeners are called as listener(folder, target, data) on the
+    # download thread with the file contents while they are written, frame_listeners as listener(folder, target)
+    # on the save thread once the frame is on disk, and stack_listeners as listener(folder) once the last frame
+    # of a stack is saved. Saved frames and stack runs are recorded in the catalog, which several engines,
+    # one per rig, can share.
+    def __init__(self, camera=None, capture_folder=CAPTURE_FOLDER, catalog=None, name=None):
+        self.name = name
+        self.camera = camera or Camera()
+        self.stepper = None
+        self.capture_folder = capture_folder
+        self.download_listeners = []
+        self.frame_listeners = []
+        self.stack_listeners = []
+        self.stop_event = threading.Event()
+        self.stacking = threading.Event()  # Set during run_stack, when camera events belong to the captures
+        self.download_queue = queue.Queue()
+        self.save_queue = queue.Queue()
+        os.makedirs(capture_folder, exist_ok=True)
+        self.catalog = catalog or Catalog(capture_folder)
+        self.workers = [
+            threading.Thread(target=self.download_worker, name=f"{name or 'engine'} download", daemon=True),
+            threading.Thread(target=self.save_worker, name=f"{name or 'engine'} save", daemon=True),
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def connect_stepper(self, tty, baudrate):
+        self.disconnect_stepper()
+        self.stepper = StepperChannel(tty, baudrate)
+
+    def discover_stepper(self, baudrate):
+        # Returns the tty of the stepper found, or None
+        channel = find_stepper(baudrate)
+        if channel:
+            self.disconnect_stepper()
+            self.stepper = channel
+            return channel.tty
+
+    def disconnect_stepper(self):
+        if self.stepper and self.stepper.is_open:
+            self.stepper.close()
+        self.stepper = None
+
+    def send(self, command):
+        if self.stepper:
+            self.stepper.send(command)
+        else:
+            print("Arduino not connected")
+
+    def move(self, command):
+        if self.stepper:
+            return self.stepper.move(command)
+        print("Arduino not connected")
+        return False
+
+    def download(self, file_path, folder):
+        try:
+            target_folder = os.path.join(self.capture_folder, folder)
+            os.makedirs(target_folder, exist_ok=True)
+            target = os.path.join(target_folder, file_path.name)
+            data = self.camera.download(file_path)
+            self.save_queue.put((folder, target, data))
+            self.notify_download(folder, target, data)
+            return target
+        except gp.GPhoto2Error as e:
+            print(f"Failed to process captured image: {e}")
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+
+    def notify_download(self, folder, target, data):
+        for listener in self.download_listeners:
+            try:
+                listener(folder, target, data)
+            except Exception as e:
+                print(f"Download listener failed on {target}: {e}")
+
+    def save(self, folder, target, data):
+        try:
+            write_frame(target, data)
+            self.saved(folder, target)
+        except Exception as e:
+            print(f"Failed to save {target}: {e}")
+
+    def saved(self, folder, target):
+        print(f"Image saved to {target}")
+        self.catalog.add_image(target)
+        for listener in self.frame_listeners:
+            listener(folder, target)
+
+    def transfer(self, file_paths, folder):
+        # End of a burst: the frames left on the card are read back to back while a pool of writers saves
+        # them and another thread calls the download listeners, in capture order, so decoding does not hold
+        # up the reads. Frames verified on disk are deleted from the card, those that fail the checks stay there.
+        target_folder = os.path.join(self.capture_folder, folder)
+        os.makedirs(target_folder, exist_ok=True)
+        writes = deque()
+        saved = 0
+        with ThreadPoolExecutor(TRANSFER_WRITERS) as writers, ThreadPoolExecutor(1) as notifier:
+            for file_path in file_paths:
+                target = os.path.join(target_folder, file_path.name)
+                try:
+                    expected_size = self.camera.file_size(file_path)
+                    data = self.camera.download(file_path)
+                except gp.GPhoto2Error as e:
+                    print(f"Failed to transfer {file_path.name}: {e}")
+                    continue
+                if len(data) != expected_size:
+                    print(f"Received {len(data)} bytes of {file_path.name} instead of {expected_size}")
+                    continue
+                write = writers.submit(write_frame, target, data)
+                notified = notifier.submit(self.notify_download, folder, target, data)
+                writes.append((file_path, target, len(data), write, notified))
+                saved += self.finish_writes(folder, writes, TRANSFER_PENDING)
+            saved += self.finish_writes(folder, writes, 0)
+        print(f"Transferred {saved} of {len(file_paths)} frames")
+        return saved
+
+    def finish_writes(self, folder, writes, pending):
+        # Notifies the writes completed so far, in order, waiting until at most pending are left, which also
+        # bounds the frames waiting for the download listeners. Returns how many were verified.
+        verified = 0
+        while writes and (len(writes) > pending or (writes[0][3].done() and writes[0][4].done())):
+            file_path, target, size, write, notified = writes.popleft()
+            notified.result()  # Frame listeners may use what the download listeners made
+            try:
+                write.result()
+                if os.path.getsize(target) != size:
+                    raise OSError(f"{os.path.getsize(target)} bytes on disk instead of {size}")
+            except OSError as e:
+                print(f"Failed to save {target}: {e}")
+                continue
+            self.saved(folder, target)
+            verified += 1
+            try:
+                self.camera.delete(file_path)
+            except gp.GPhoto2Error as e:
+                print(f"Failed to delete {file_path.name} from the card: {e}")
+        return verified
+
+    def save_worker(self):
+        while True:
+            folder, target, data = self.save_queue.get()
+            try:
+                self.save(folder, target, data)
+            finally:
+                self.save_queue.task_done()
+
+    def download_worker(self):
+        while True:
+            file_path, folder = self.download_queue.get()
+            try:
+                self.download(file_path, folder)
+            finally:
+                self.download_queue.task_done()
+
+    def capture(self):
+        try:
+            return self.camera.capture()
+        except gp.GPhoto2Error as e:
+            print(f"Failed to capture image: {e}")
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+
+    def capture_single(self, folder="Singles"):
+        file_path = self.capture()
+        if file_path:
+            target = self.download(file_path, folder)
+            self.save_queue.join()
+            return target
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run_stack(self, job):
+        # Blocks until the stack is captured and every frame is saved, returns the stack folder name
+        num_frames = int(job["frames"])
+        angle = int(job["angle"])
+        pre_shot_delay = float(job.get("delay", 1))
+        folder = job.get("folder") or new_stack_folder(self.name)
+        pipelined = job.get("pipelined", True)
+        settle = job.get("settle", False)  # Fire once the preview is still, the delay becoming the upper bound
+        settle_threshold = float(job.get("settle_threshold", settling.SETTLE_THRESHOLD))
+        settle_time = float(job.get("settle_time", settling.SETTLE_TIME))
+        burst = job.get("burst", False)  # Frames stay on the card until the stack is over, see transfer
+        self.stop_event.clear()
+        run = tracer.begin_run(folder, self.workers)
+        self.catalog.begin_stack(folder, job)
+        captured = 0
+        burst_files = []
+        if burst:
+            try:
+                previous_target = self.camera.set_config("capturetarget", "card")
+            except (gp.GPhoto2Error, ValueError) as e:
+                print(f"Failed to capture to the card, downloading each frame instead: {e}")
+                burst = False
+        self.stacking.set()
+        self.send("A")
+        try:
+            for frame_index in range(num_frames):
+                with tracer.span("pre-shot wait", index=frame_index):
+                    if settle:
+                        waited = self.settle(pre_shot_delay, settle_threshold, settle_time)
+                        stopped = waited is None
+                        if not stopped:
+                            print(f"Frame {frame_index + 1}: settled after {waited:.2f} seconds")
+                    else:
+                        stopped = self.stop_event.wait(pre_shot_delay)
+                if stopped:
+                    break
+                if pipelined and not burst:
+                    self.download_queue.join()  # The camera must hand over the previous frame first
+                file_path = self.capture()
+                if file_path:
+                    captured += 1
+                if burst:
+                    if file_path:
+                        burst_files.append(file_path)
+                    self.move(f"U{angle}")
+                elif pipelined:
+                    if file_path:
+                        self.download_queue.put((file_path, folder))
+                    self.move(f"U{angle}")
+                else:
+                    if file_path:
+                        self.download(file_path, folder)
+                    self.move(f"U{angle}")
+        finally:
+            self.send("R")
+            if burst:
+                self.transfer(burst_files, folder)
+                try:
+                    self.camera.set_config("capturetarget", previous_target)
+                except (gp.GPhoto2Error, ValueError) as e:
+                    print(f"Failed to restore the capture target: {e}")
+            self.download_queue.join()
+            self.save_queue.join()
+            self.catalog.end_stack(folder, captured)
+            self.save_trace(folder, tracer.end_run(run))
+            self.stacking.clear()
+            for listener in self.stack_listeners:
+                listener(folder)
+        return folder
+
+    def settle(self, max_wait, threshold=settling.SETTLE_THRESHOLD, settle_time=settling.SETTLE_TIME):
+        # Samples previews until they stop changing for settle_time, at most max_wait seconds.
+        # Returns the seconds waited, or None when the stack was stopped.
+        if max_wait <= 0:
+            return None if self.stop_event.is_set() else 0  # No delay to shorten
+        start = time.time()
+        previous = None
+        previous_time = None
+        still_since = None
+        while not self.stop_event.is_set():
+            if time.time() - start >= max_wait:
+                print(f"Not settled after {max_wait} seconds")
+                return time.time() - start
+            try:
+                current = settling.preview_luma(self.camera.capture_preview())
+            except gp.GPhoto2Error as e:
+                print(f"Failed to capture preview, waiting the full delay: {e}")
+                return None if self.stop_event.wait(max(0, max_wait - (time.time() - start))) else max_wait
+            except Exception as e:
+                print(f"Failed to decode preview, waiting the full delay: {e}")
+                return None if self.stop_event.wait(max(0, max_wait - (time.time() - start))) else max_wait
+            now = time.time()
+            if previous is not None and settling.motion_energy(previous, current) < threshold:
+                still_since = still_since or previous_time
+                if now - still_since >= settle_time:
+                    return now - start
+            else:
+                still_since = None
+            previous, previous_time = current, now
+        return None
+
+    def save_trace(self, folder, spans):
+        # Chrome/Perfetto trace and per-phase summary of the run, next to its frames
+        summary = tracer.summary(spans)
+        print(summary)
+        target_folder = os.path.join(self.capture_folder, folder)
+        if os.path.isdir(target_folder):
+            tracer.export(os.path.join(target_folder, "trace.json"), spans)
+            with open(os.path.join(target_folder, "timing.txt"), "w") as file:
+                file.write(summary + "\n")
+
+    def run_job(self, job):
+        # A job of the job runner: optional focus sweep then the stack, returns the folder or None
+        if job.get("auto_plan"):
+            plan = self.sweep_focus(int(job.get("sweep_range", 360)), int(job.get("sweep_step", 10)))
+            if plan is None:
+                print("No focus range found during the sweep, skipping job")
+                return None
+            job = dict(job, frames=plan["frames"], angle=plan["step"])
+        return self.run_stack(job)
+
+    def sweep_focus(self, sweep_range, sweep_step):
+        # Sweeps the knob while measuring preview sharpness and returns to where focus begins, see focus_planning
+        if self.stepper is None:
+            print("Arduino not connected")  # The knob would not turn and every sample would be the same
+            return None
+        angles = []
+        samples = []
+        position = 0
+        plan = None
+        self.send("A")
+        try:
+            while True:
+                time.sleep(SWEEP_SETTLE)
+                file_data = self.camera.capture_preview()
+                samples.append(focus_planning.tile_sharpness(decode_preview(file_data, SWEEP_PREVIEW_SIZE)))
+                angles.append(position)
+                if position + sweep_step > sweep_range:
+                    break
+                self.move(f"U{sweep_step}")
+                position += sweep_step
+            plan = focus_planning.plan_stack(angles, samples)
+        except gp.GPhoto2Error as e:
+            print(f"Failed to capture preview: {e}")
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+        finally:
+            back = position - plan["start"] if plan else position
+            if back > 0:
+                self.move(f"D{back}")
+            self.send("R")
+        return plan
+
+def parse_job(spec):
+    # FRAMES:ANGLE[:DELAY[:FOLDER]]
+    fields = spec.split(":")
+    job = {"frames": int(fields[0]), "angle": int(fields[1])}
+    if len(fields) > 2:
+        job["delay"] = float(fields[2])
+    if len(fields) > 3:
+        job["folder"] = fields[3]
+    return job
+
+def load_jobs(job_files, job_specs):
+    jobs = []
+    for job_file in job_files:
+        with open(job_file) as file:
+            jobs.extend(json.load(file))
+    jobs.extend(parse_job(spec) for spec in job_specs)
+    return jobs
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture a queue of focus stacks without the GUI")
+    parser.add_argument("job_files", nargs="*", help="JSON files holding a list of jobs with frames, angle, delay, folder and optionally auto_plan, sweep_range, sweep_step, stack")
+    parser.add_argument("--job", action="append", default=[], help="FRAMES:ANGLE[:DELAY[:FOLDER]], may be repeated")
+    parser.add_argument("--tty", help="Serial port of the stepper, found by probing the USB serial ports when omitted")
+    parser.add_argument("--baudrate", default="9600")
+    parser.add_argument("--pause", type=float, default=0, help="Seconds to wait between jobs")
+    parser.add_argument("--stack", action="store_true", help="Focus stack every folder once captured")
+    parser.add_argument("--burst", action="store_true", help="Keep frames on the card during each stack and transfer them at the end")
+    parser.add_argument("--settle", action="store_true", help="Shoot as soon as the preview is still, the delay being the upper bound")
+    args = parser.parse_args()
+
+    jobs = load_jobs(args.job_files, args.job)
+    if not jobs:
+        parser.error("no jobs given")
+    engine = Engine()
+    if not engine.camera.connect():
+        raise SystemExit(1)
+    if args.tty:
+        engine.connect_stepper(args.tty, args.baudrate)
+    elif engine.discover_stepper(args.baudrate) is None:
+        print("No stepper found on the USB serial ports")
+        raise SystemExit(1)
+    try:
+        for index, job in enumerate(jobs):
+            print(f"Job {index + 1}/{len(jobs)}: {job}")
+            folder = engine.run_job(dict(job, burst=job.get("burst", args.burst), settle=job.get("settle", args.settle)))
+            if folder and job.get("stack", args.stack):
+                stacking.stack_folder(os.path.join(engine.capture_folder, folder))
+            if index < len(jobs) - 1:
+                time.sleep(args.pause)
+    except KeyboardInterrupt:
+        engine.stop()
+    finally:
+        engine.disconnect_stepper()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Stack planning from a sharpness sweep: the preview is split into a grid of tiles and each tile's
+# sharpness is recorded at every knob position. Each textured tile peaks where its part of the
+# specimen is in focus and the width of that peak approximates the depth of field in degrees.
+
+import math
+import numpy as np
+from stacking import focus_energy
+
+PLANNING_GRID = 8  # Tiles per side of the preview
+MIN_CONTRAST = 1.5  # Peak to baseline sharpness ratio below which a tile is considered featureless
+DOF_OVERLAP = 0.7  # Step angle as a fraction of the depth of field, so consecutive frames overlap
+
+def tile_sharpness(image, grid=PLANNING_GRID):
+    energy = focus_energy(np.asarray(image.convert("RGB")), radius=1)
+    height = energy.shape[0] // grid * grid
+    width = energy.shape[1] // grid * grid
+    tiles = energy[:height, :width].reshape(grid, height // grid, grid, width // grid)
+    return tiles.mean(axis=(1, 3)).ravel()
+
+def peak_width(curve, peak_index):
+    # Number of samples around the peak above half its height
+    half = curve.min() + (curve[peak_index] - curve.min()) / 2
+    first = last = peak_index
+    while first > 0 and curve[first - 1] >= half:
+        first -= 1
+    while last < len(curve) - 1 and curve[last + 1] >= half:
+        last += 1
+    return last - first + 1
+
+def plan_stack(angles, samples):
+    # Returns {"start", "end", "step", "frames"} in degrees from the sweep start, or None without any focus
+    if len(angles) < 3:
+        return None
+    angles = np.asarray(angles, dtype=float)
+    sharpness = np.asarray(samples, dtype=float)  # positions x tiles
+    sweep_step = angles[1] - angles[0]
+    baseline = np.maximum(sharpness.min(axis=0), 1e-9)
+    textured = sharpness.max(axis=0) / baseline >= MIN_CONTRAST
+    if not textured.any():
+        return None
+    peaks = sharpness[:, textured].argmax(axis=0)
+    widths = np.array([peak_width(sharpness[:, tile], peak) for tile, peak in zip(np.flatnonzero(textured), peaks)]) * sweep_step
+    start = max(angles[0], float((angles[peaks] - widths / 2).min()))
+    end = min(angles[-1], float((angles[peaks] + widths / 2).max()))
+    step = max(1, int(DOF_OVERLAP * np.median(widths)))
+    frames = int(math.floor((end - start) / step)) + 1
+    return {"start": int(round(start)), "end": int(round(end)), "step": step, "frames": frames}
@@ -0,0 +1,115 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+from PIL import Image
+from collections import OrderedDict
+import io
+import os
+import threading
+from raw_preview import open_image, open_image_data
+from tracing import tracer
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.tif', '.tiff', '.cr2')
+DISPLAY_CACHE_BYTES = 256 * 1024 * 1024  # Memory budget for decoded display renditions
+
+def fit_size(image_size, frame_size):
+    # Largest size that fits in frame_size while maintaining the aspect ratio of image_size
+    image_width, image_height = image_size
+    frame_width, frame_height = frame_size
+    image_ratio = image_width / image_height
+    frame_ratio = frame_width / frame_height
+    if frame_ratio > image_ratio:
+        new_height = frame_height
+        new_width = int(new_height * image_ratio)
+    else:
+        new_width = frame_width
+        new_height = int(new_width / image_ratio)
+    return new_width, new_height
+
+def decode_preview(file_data, frame_size):
+    image = Image.open(io.BytesIO(file_data))
+    if frame_size[0] > 0 and frame_size[1] > 0:
+        image.draft("RGB", frame_size)  # Let the JPEG decoder downscale while decoding
+        new_size = fit_size(image.size, frame_size)
+        if new_size[0] > 0 and new_size[1] > 0:
+            return image.resize(new_size, Image.NEAREST)
+    image.load()
+    return image
+
+def load_rendition(image_path, frame_size):
+    return render(open_image(image_path, frame_size), frame_size)
+
+def decode_rendition(data, image_path, frame_size):
+    # Rendition of a frame still in memory, before or while it is written to disk
+    return render(open_image_data(data, image_path, frame_size), frame_size)
+
+def render(image, frame_size):
+    image.draft("RGB", frame_size)  # JPEG files can be decoded directly at a reduced scale
+    new_size = fit_size(image.size, frame_size)
+    if new_size[0] <= 0 or new_size[1] <= 0:
+        return None
+    return image.resize(new_size, Image.NEAREST)
+
+def image_bytes(image):
+    return image.width * image.height * len(image.getbands())
+
+class RenditionCache:
+    # Least recently used display renditions keyed by path and target size, bounded by a byte budget
+    def __init__(self, max_bytes=DISPLAY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, image_path, frame_size):
+        key = (os.path.normpath(image_path), tuple(frame_size))
+        with self.lock:
+            image = self.entries.get(key)
+            if image is not None:
+                self.entries.move_to_end(key)
+            return image
+
+    def put(self, image_path, frame_size, image):
+        key = (os.path.normpath(image_path), tuple(frame_size))
+        size = image_bytes(image)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.used_bytes -= image_bytes(previous)
+            self.entries[key] = image
+            self.used_bytes += size
+            while self.used_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.used_bytes -= image_bytes(evicted)
+
+    def forget(self, image_path):
+        # Drops every entry of a file that changed
+        image_path = os.path.normpath(image_path)
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == image_path]:
+                self.used_bytes -= image_bytes(self.entries.pop(key))
+
+    def rendition(self, image_path, frame_size):
+        image = self.get(image_path, frame_size)
+        if image is None:
+            with tracer.span("display decode", file=os.path.basename(image_path)):
+                image = load_rendition(image_path, frame_size)
+            if image is not None:
+                self.put(image_path, frame_size, image)
+        return image
@@ -20,30 +20,29 @@ from tkinter import ttk
 from ttkthemes import ThemedTk
 from PIL import Image, ImageTk
 import os
-import serial
 import gphoto2 as gp
 import subprocess
-import io
 import time
 import threading
+import queue
+import itertools
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError, wait, FIRST_COMPLETED
+from thumbnail_cache import ThumbnailCache, thumbnail_data, decode_thumbnail, THUMBNAIL_WORKERS
+from image_cache import RenditionCache, fit_size, decode_preview, decode_rendition
+from raw_preview import open_image
+import stacking
+import alignment
+from camera_settings import CameraSettings
+from engine import Engine, CAPTURE_FOLDER, new_stack_folder, serial_candidates
+from tracing import tracer
+from zoom_view import TileStore, ZoomView
 
-arduino = None  # Variable to store the serial connection
 camera_preview_active = False  # Variable to track camera preview state
-subprocess.call(["gio", "mount", "-s", "gphoto2"])
-subprocess.call(["mkdir", "-p", "Capture"])
-
-camera_connected = False  # Variable to track camera connection state
-
-try:
-    camera = gp.check_result(gp.gp_camera_new())
-    gp.check_result(gp.gp_camera_init(camera))
-    config = gp.check_result(gp.gp_camera_get_config(camera))
-    gp.gp_camera_capture_preview(camera)
-    camera_connected = True
-except gp.GPhoto2Error as e:
-    print(f"Failed to initialize camera: {e}")
-except Exception as e:
-    print(f"Unexpected error: {e}")
+
+TREE_ROW_HEIGHT = 40
+THUMBNAIL_BATCH = 20  # PhotoImages created per Tk callback, so a large library never stalls the UI
+FRESH_THUMBNAIL_TIMEOUT = 5  # Seconds a saved frame waits for the decode of its download before decoding the file
 
 def setup_window():
     window = ThemedTk(theme="arc")
@@ -80,7 +79,7 @@ def setup_strip_frame(window):
 
 def setup_treeview(strip_frame):
     style = ttk.Style()
-    style.configure("Treeview", rowheight=40)  # Reduce row height to save space
+    style.configure("Treeview", rowheight=TREE_ROW_HEIGHT)  # Reduce row height to save space
     treeview = ttk.Treeview(strip_frame, columns=("Image"), show="tree", selectmode='extended', style="Treeview")  # Allow multiple selection
     send_to_zerene_button = ttk.Button(strip_frame, text="Send to Zerene", command=lambda: send_to_zerene(treeview))
     send_to_zerene_button.pack(side=tk.TOP, fill=tk.X, pady=5)
@@ -88,8 +87,12 @@ def setup_treeview(strip_frame):
     scrollbar = ttk.Scrollbar(strip_frame, orient=tk.VERTICAL, command=treeview.yview)
     scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
     treeview.configure(yscrollcommand=scrollbar.set)
+    treeview.scrollbar = scrollbar
     treeview.image_dict = {}
     treeview.image_thumbnails = {}  # Dictionary to store image thumbnails
+    treeview.path_index = {}  # Image path -> tree item
+    treeview.item_paths = {}  # Tree item -> image path
+    treeview.pending_files = {}  # Folder item -> image paths not inserted until the folder is expanded
     
     return treeview
 
@@ -178,7 +181,45 @@ def main():
     last_selected_image_path = None
     resize_timer = None
     stack_folder = None
-    stop_capture = False  # Initialize stop_capture
+    engine = Engine()
+    camera_settings = None
+    singles_id = None
+    completed_frames = queue.Queue()  # Saved frames waiting to be shown by the Tk thread
+    thumbnail_cache = ThumbnailCache(os.path.join(CAPTURE_FOLDER, ".thumbnails.sqlite"))
+    thumbnail_timer = None
+    filter_timer = None
+    thumbnail_requests = queue.PriorityQueue()  # (priority, order, item, path) of rows missing from the thumbnail cache, visible rows first
+    thumbnail_results = queue.Queue()  # (item, thumbnail) decoded by the thumbnail processes
+    requested_thumbnails = {}  # Item -> priority it was last requested with
+    request_order = itertools.count()
+    library_paths = []  # Every image found in the library at startup
+    rendition_cache = RenditionCache()
+    display_state = {"frame_size": (0, 0)}  # Size of the last rendition shown, read by the download thread
+    fresh_thumbnails = {}  # Target -> Future of the thumbnail decoded from the download, None when it failed
+    fresh_thumbnails_lock = threading.Lock()
+    stream_requests = queue.Queue()  # (stack folder, saved frame) to fuse, a None frame ends the stack
+    stream_results = queue.Queue()  # Partial composites and finished stacks for the Tk thread
+    streaming_state = {"folder": None, "frame_size": (0, 0)}
+    alignment_requests = queue.Queue()  # (stack folder path, saved frame) to align against the previous frame
+    alignment_results = queue.Queue()  # Alignment entries for the Tk thread
+    prefetch_requests = queue.Queue()  # (path, frame size) of neighbours to decode ahead of time
+    preview_frames = queue.Queue(maxsize=1)  # Latest decoded preview frame, older frames are dropped
+    preview_state = {"thread": None, "frame_size": (0, 0), "shown": 0, "dropped": 0, "since": time.time()}
+
+    def run_in_background(func, callback):
+        # Runs func on a worker thread and hands its result to callback on the Tk thread
+        result = queue.Queue(maxsize=1)
+        threading.Thread(target=lambda: result.put(func()), daemon=True).start()
+
+        def poll():
+            try:
+                value = result.get_nowait()
+            except queue.Empty:
+                window.after(5, poll)
+                return
+            callback(value)
+
+        poll()
 
     def toggle_camera_preview():
         global camera_preview_active
@@ -186,6 +227,11 @@ def main():
         if camera_preview_active:
             camera_button.config(text="Stop Preview")
             print("Camera preview activated")
+            preview_state.update(shown=0, dropped=0, since=time.time())
+            zoom_view.reset(None)  # Live frames are always fitted
+            if not (preview_state["thread"] and preview_state["thread"].is_alive()):
+                preview_state["thread"] = threading.Thread(target=preview_producer, daemon=True)
+                preview_state["thread"].start()
             update_camera_preview()
         else:
             camera_button.config(text="Start Preview")
@@ -194,212 +240,541 @@ def main():
                 show_full_image(last_selected_image_path)
 
     def capture_and_process_image():
-        file_path = capture_image()
-        process_captured_image(file_path, "Singles")
-
-    def capture_image():
+        run_in_background(lambda: engine.capture_single("Singles"), lambda target: None)
+
+    def fresh_thumbnail(target):
+        # Created by whichever of the download and save listeners comes first
+        with fresh_thumbnails_lock:
+            return fresh_thumbnails.setdefault(target, Future())
+
+    def on_frame_downloaded(folder, target, data):
+        # Called on the engine's download thread while the frame is written, one decode from memory
+        # gives both the display rendition and the thumbnail
+        thumbnail = None
+        frame_size = display_state["frame_size"]
         try:
-            print("Capturing image")
-            start_time = time.time()
-            file_path = gp.check_result(gp.gp_camera_capture(camera, gp.GP_CAPTURE_IMAGE))
-            end_time = time.time()
-            print(f"Time taken to capture image: {end_time - start_time} seconds")
-            return file_path
-        except gp.GPhoto2Error as e:
-            print(f"Failed to capture image: {e}")
+            if frame_size[0] > 0 and frame_size[1] > 0:
+                with tracer.span("display decode", file=os.path.basename(target)):
+                    rendition = decode_rendition(data, target, frame_size)
+                if rendition is not None:
+                    rendition_cache.put(target, frame_size, rendition)
+                    thumbnail = rendition.copy()
+                    thumbnail.thumbnail(thumbnail_cache.size)
         except Exception as e:
-            print(f"Unexpected error: {e}")
+            print(f"Failed to decode {target}: {e}")
+        finally:
+            future = fresh_thumbnail(target)
+            if not future.done():
+                future.set_result(thumbnail)
+
+    def on_frame_saved(folder, target):
+        # Called on the engine's save thread
+        if streaming_state["folder"] == folder:
+            stream_requests.put((folder, target))
+        if folder == stack_folder:
+            alignment_requests.put((os.path.dirname(target), target))
+        try:
+            thumbnail = fresh_thumbnail(target).result(timeout=FRESH_THUMBNAIL_TIMEOUT)
+        except TimeoutError:
+            thumbnail = None
+        with fresh_thumbnails_lock:
+            fresh_thumbnails.pop(target, None)
+        try:
+            # Populate the cache now so the tree and later startups don't decode it again
+            if thumbnail is not None:
+                thumbnail_cache.put(target, thumbnail)
+            else:
+                thumbnail_cache.thumbnail(target)
+        except Exception as e:
+            print(f"Failed to create thumbnail for {target}: {e}")
+        completed_frames.put(target)
+
+    def on_stack_saved(folder):
+        if streaming_state["folder"] == folder:
+            stream_requests.put((folder, None))  # Lets the streaming stacker save once the last frame is in
 
-    def process_captured_image(file_path, folder):
+    def display_captured_image(target):
         try:
-            target_folder = os.path.join("Capture", folder)
-            os.makedirs(target_folder, exist_ok=True)
-            target = os.path.join(target_folder, file_path.name)
-            camera_file = gp.check_result(gp.gp_camera_file_get(camera, file_path.folder, file_path.name, gp.GP_FILE_TYPE_NORMAL))
-            gp.check_result(gp.gp_file_save(camera_file, target))
-            print(f"Image saved to {target}")
             add_image_to_treeview(target)
             show_full_image(target)  # Display the last image captured
             select_image_in_treeview(target)  # Select the last image captured in the treeview
-        except gp.GPhoto2Error as e:
-            print(f"Failed to process captured image: {e}")
         except Exception as e:
             print(f"Unexpected error: {e}")
 
+    def poll_completed_frames():
+        # Tk widgets must only be touched from the main thread, so saved frames are handed over here
+        while True:
+            try:
+                target = completed_frames.get_nowait()
+            except queue.Empty:
+                break
+            display_captured_image(target)
+        while True:
+            try:
+                kind, value = stream_results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "partial" and not camera_preview_active and not zoom_view.active:
+                display_image(value)
+            elif kind == "done":
+                add_image_to_treeview(value)
+                show_full_image(value)
+        while True:
+            try:
+                entry = alignment_results.get_nowait()
+            except queue.Empty:
+                break
+            cumulative = entry["cumulative"]
+            text = f"Drift: {cumulative['dx']:.0f}, {cumulative['dy']:.0f} px, scale {cumulative['scale']:.3f}"
+            if entry["drift"]:
+                alignment_label.config(text=f"{text} - {entry['file']} moved, retake?", foreground="red")
+            else:
+                alignment_label.config(text=text, foreground="")
+        while camera_settings is not None and not camera_settings.changes.empty():
+            widget_name = camera_settings.changes.get_nowait()
+            populate_combobox(widget_name, setting_comboboxes[widget_name])  # Changed on the camera body
+        window.after(50, poll_completed_frames)
+
+    def alignment_worker():
+        # Measures the drift of each stack frame against the previous one while the capture goes on
+        aligner = None
+        while True:
+            target_folder, target = alignment_requests.get()
+            try:
+                if aligner is None or aligner.folder != target_folder:
+                    aligner = alignment.StackAligner(target_folder)
+                entry = aligner.add_frame(target)
+                if entry["drift"]:
+                    print(f"Large drift on {target}: dx={entry['dx']:.1f} dy={entry['dy']:.1f} scale={entry['scale']:.4f}")
+                alignment_results.put(entry)
+            except Exception as e:
+                print(f"Failed to align {target}: {e}")
+
+    def streaming_worker():
+        # Fuses each stack frame into a running composite as soon as it is saved
+        stacker = None
+        stacker_folder = None
+        while True:
+            folder, target = stream_requests.get()
+            try:
+                if target is None:
+                    if stacker is not None and stacker_folder == folder:
+                        output_path = os.path.join(stacking.STACKED_FOLDER, folder + ".tif")
+                        os.makedirs(stacking.STACKED_FOLDER, exist_ok=True)
+                        stacker.result().save(output_path)
+                        engine.catalog.add_image(output_path)
+                        print(f"Stacked {stacker.count} frames into {output_path}")
+                        stream_results.put(("done", output_path))
+                        stacker.close()
+                        stacker = None
+                    continue
+                if stacker is None or stacker_folder != folder:
+                    if stacker is not None:
+                        stacker.close()
+                    stacker = stacking.StreamingStacker()
+                    stacker_folder = folder
+                stacker.add_frame(open_image(target))
+                composite = stacker.result()
+                frame_size = streaming_state["frame_size"]
+                if frame_size[0] > 0 and frame_size[1] > 0:
+                    stream_results.put(("partial", composite.resize(fit_size(composite.size, frame_size), Image.NEAREST)))
+            except Exception as e:
+                print(f"Failed to stack {target}: {e}")
+
+    def add_folder_to_treeview(folder_name, image_paths=()):
+        parent_id = treeview.insert('', 'end', text=folder_name, open=False)
+        treeview.image_dict[folder_name] = parent_id
+        if image_paths:
+            treeview.pending_files[parent_id] = list(image_paths)
+            treeview.insert(parent_id, 'end', text="")  # Placeholder so the folder can be expanded
+        return parent_id
+
+    def populate_folder(parent_id):
+        image_paths = treeview.pending_files.pop(parent_id, None)
+        if image_paths is None:
+            return
+        treeview.delete(*treeview.get_children(parent_id))
+        for image_path in image_paths:
+            item = insert_image_item(parent_id, image_path)
+            request_thumbnail(item, image_path, 1)  # Behind the rows on screen, queued once as the folder opens
+
+    def insert_image_item(parent_id, image_path):
+        image_path = os.path.normpath(image_path)
+        new_item = treeview.insert(parent_id, 'end', text=os.path.basename(image_path))
+        treeview.path_index[image_path] = new_item
+        treeview.item_paths[new_item] = image_path
+        return new_item
+
     def add_image_to_treeview(image_path):
-        image = Image.open(image_path)
-        image.thumbnail((50, 50), Image.NEAREST)  # Adjust thumbnail size to fit within the tree view
+        image = thumbnail_cache.thumbnail(image_path)
         photo = ImageTk.PhotoImage(image)
         parent_folder = os.path.basename(os.path.dirname(image_path))
         if parent_folder == "Capture":
             parent_folder = os.path.basename(os.path.dirname(os.path.dirname(image_path)))
         if parent_folder not in treeview.image_dict:
-            parent_id = treeview.insert('', 'end', text=parent_folder, open=True)
-            treeview.image_dict[parent_folder] = parent_id
+            parent_id = add_folder_to_treeview(parent_folder)
         else:
             parent_id = treeview.image_dict[parent_folder]
-        image_name = os.path.basename(image_path)
-        new_item = treeview.insert(parent_id, 'end', text=image_name, image=photo)
+            populate_folder(parent_id)
+        treeview.item(parent_id, open=True)
+        new_item = treeview.path_index.get(os.path.normpath(image_path))
+        if new_item is None:
+            new_item = insert_image_item(parent_id, image_path)
+        treeview.item(new_item, image=photo)
         treeview.image_thumbnails[new_item] = photo  # Keep a reference to the PhotoImage object
         treeview.selection_set(new_item)
         treeview.see(new_item)
 
     def select_image_in_treeview(image_path):
-        if os.path.isfile(image_path):
-            for item in treeview.get_children():
-                for sub_item in treeview.get_children(item):
-                    if treeview.item(sub_item, "text") == os.path.basename(image_path):
-                        treeview.selection_set(sub_item)
-                        treeview.see(sub_item)
-                        break
+        item = treeview.path_index.get(os.path.normpath(image_path))
+        if item:
+            treeview.selection_set(item)
+            treeview.see(item)
 
     def show_full_image(image_path):
         nonlocal current_image_path, last_selected_image_path
         if not camera_preview_active and os.path.isfile(image_path):
             current_image_path = image_path
             last_selected_image_path = image_path
-            image = Image.open(image_path)
-            resize_and_display_image(image)
-
-    def resize_and_display_image(image):
-        # Calculate the new size while maintaining the aspect ratio
-        frame_width = image_frame.winfo_width()
-        frame_height = image_frame.winfo_height()
-
-        if frame_width > 0 and frame_height > 0:
-            image_ratio = image.width / image.height
-            frame_ratio = frame_width / frame_height
-
-            if frame_ratio > image_ratio:
-                new_height = frame_height
-                new_width = int(new_height * image_ratio)
-            else:
-                new_width = frame_width
-                new_height = int(new_width / image_ratio)
+            zoom_view.reset(image_path)
+            display_rendition(image_path)
+            prefetch_neighbours(image_path)
+
+    def display_rendition(image_path):
+        frame_size = (image_frame.winfo_width(), image_frame.winfo_height())
+        if frame_size[0] > 0 and frame_size[1] > 0:
+            display_state["frame_size"] = frame_size
+            image = rendition_cache.rendition(image_path, frame_size)
+            if image is not None:
+                display_image(image)
+
+    def prefetch_neighbours(image_path):
+        # Decode the previous and next images of the folder in the background so browsing a stack is instant
+        item = treeview.path_index.get(os.path.normpath(image_path))
+        if item is None:
+            return
+        frame_size = (image_frame.winfo_width(), image_frame.winfo_height())
+        while not prefetch_requests.empty():  # Drop requests for images the user has already moved past
+            try:
+                prefetch_requests.get_nowait()
+            except queue.Empty:
+                break
+        for neighbour in (treeview.next(item), treeview.prev(item)):
+            neighbour_path = treeview.item_paths.get(neighbour)
+            if neighbour_path and frame_size[0] > 0 and frame_size[1] > 0:
+                prefetch_requests.put((neighbour_path, frame_size))
+
+    def prefetch_worker():
+        while True:
+            image_path, frame_size = prefetch_requests.get()
+            try:
+                rendition_cache.rendition(image_path, frame_size)
+            except Exception as e:
+                print(f"Failed to prefetch {image_path}: {e}")
 
-            if new_width > 0 and new_height > 0:
-                resized_image = image.resize((new_width, new_height), Image.NEAREST)  # Use resize instead of thumbnail
-                photo = ImageTk.PhotoImage(resized_image)
-                full_image_canvas.itemconfig(streaming_image, image=photo)
-                full_image_canvas.coords(streaming_image, frame_width // 2, frame_height // 2)  # Center the image
-                full_image_canvas.photo = photo  # Keep a reference to the PhotoImage object
+    def display_image(image):
+        with tracer.span("display", category="ui"):
+            photo = ImageTk.PhotoImage(image)
+        full_image_canvas.itemconfig(streaming_image, image=photo)
+        full_image_canvas.coords(streaming_image, image_frame.winfo_width() // 2, image_frame.winfo_height() // 2)  # Center the image
+        full_image_canvas.photo = photo  # Keep a reference to the PhotoImage object
 
     def schedule_final_resize():
         nonlocal resize_timer
         resize_timer = None
-        if not camera_preview_active and current_image_path:
-            image = Image.open(current_image_path)
-            resize_and_display_image(image)
-
-    def update_camera_preview():
-        if camera_preview_active:
+        if zoom_view.active:
+            zoom_view.render()
+        elif not camera_preview_active and current_image_path:
+            display_rendition(current_image_path)
+            prefetch_neighbours(current_image_path)
+
+    def preview_producer():
+        # Acquires and decodes preview frames off the Tk thread, keeping only the newest one
+        while camera_preview_active:
             try:
-                camera_file = gp.check_result(gp.gp_camera_capture_preview(camera))
-                file_data = gp.check_result(gp.gp_file_get_data_and_size(camera_file))
-                image = Image.open(io.BytesIO(file_data))
-                resize_and_display_image(image)
+                file_data = engine.camera.capture_preview()
+                with tracer.span("decode", category="preview"):
+                    image = decode_preview(file_data, preview_state["frame_size"])
             except gp.GPhoto2Error as e:
-                if e.code == gp.GP_ERROR_IO:
-                    print(f"Failed to capture preview: {e}")
-                    window.after(200, update_camera_preview)  # Wait a bit before retrying
-                else:
-                    print(f"Failed to capture preview: {e}")
+                print(f"Failed to capture preview: {e}")
+                time.sleep(0.2)  # Wait a bit before retrying
+                continue
             except Exception as e:
                 print(f"Unexpected error: {e}")
-            window.after(round(1000/30), update_camera_preview)  # Increase interval to 200ms
+                time.sleep(0.2)
+                continue
+            try:
+                preview_frames.put_nowait(image)
+            except queue.Full:
+                try:
+                    preview_frames.get_nowait()  # The Tk side has not shown the previous frame yet
+                    preview_state["dropped"] += 1
+                except queue.Empty:
+                    pass
+                preview_frames.put_nowait(image)
+
+    def update_camera_preview():
+        if camera_preview_active:
+            preview_state["frame_size"] = (image_frame.winfo_width(), image_frame.winfo_height())
+            try:
+                image = preview_frames.get_nowait()
+                display_image(image)
+                preview_state["shown"] += 1
+            except queue.Empty:
+                pass
+            elapsed = time.time() - preview_state["since"]
+            if elapsed >= 1:
+                fps = preview_state["shown"] / elapsed
+                preview_stats_label.config(text=f"Preview: {fps:.1f} fps, {preview_state['dropped']} dropped")
+                preview_state["shown"] = 0
+                preview_state["since"] = time.time()
+            window.after(10, update_camera_preview)
         else:
             if last_selected_image_path:
                 show_full_image(last_selected_image_path)
 
-    def capture_stack_step(frame_index, num_frames, pre_shot_delay, angle):
-        if stop_capture or frame_index >= num_frames:
-            send_command_to_arduino("R")
-            launch_button.config(style="TButton")
+    def stack_selected_folders():
+        # Runs the built-in stacking engine on the selected folders without blocking the UI
+        folders = [treeview.item(item, "text") for item in treeview.selection() if not treeview.parent(item)]
+        if not folders:
+            print("Please select at least one folder in the tree view.")
             return
-        
-        def capture_next_image():
-            file_path = capture_image()
-            rotate_knob()
-            process_captured_image(file_path, stack_folder)
-
-        def rotate_knob():
-            send_command_to_arduino(f"U{angle}")
-            rot_time = 2 * angle / 360  # Time to rotate the stage by the specified angle
-            window.after(round(rot_time) * 1000, lambda: capture_stack_step(frame_index + 1, num_frames, pre_shot_delay, angle))
-
-        window.after(round(pre_shot_delay) * 1000, capture_next_image)
-
-    def capture_stack():
-        nonlocal stop_capture, stack_folder
-        stop_capture = False
-        num_frames = int(frames_spinbox.get())
-        pre_shot_delay = int(pre_shot_delay_spinbox.get())
-        angle = int(angle_stacking_spinbox.get())
-        stack_folder = f"Stack_{time.strftime('%Y%m%d_%H%M%S')}"
-        os.makedirs(stack_folder, exist_ok=True)
-        send_command_to_arduino("A")
+        stack_button.config(state=tk.DISABLED)
+
+        def stack_all():
+            outputs = []
+            for folder in folders:
+                try:
+                    output_path = stacking.stack_folder(os.path.join(CAPTURE_FOLDER, folder))
+                    engine.catalog.add_image(output_path)
+                    outputs.append(output_path)
+                except Exception as e:
+                    print(f"Failed to stack {folder}: {e}")
+            return outputs
+
+        def on_stacked(outputs):
+            stack_button.config(state=tk.NORMAL)
+            for output_path in outputs:
+                add_image_to_treeview(output_path)
+                show_full_image(output_path)
+
+        run_in_background(stack_all, on_stacked)
+
+    def capture_stack(num_frames=None, angle=None):
+        nonlocal stack_folder
+        job = {
+            "frames": num_frames or int(frames_spinbox.get()),
+            "angle": angle or int(angle_stacking_spinbox.get()),
+            "delay": float(pre_shot_delay_spinbox.get()),
+            "pipelined": pipelined_var.get(),
+            "burst": burst_var.get(),
+            "settle": settle_var.get(),
+            "settings": dict(camera_settings.values) if camera_settings else {},  # Recorded with the stack in the catalog
+        }
+        stack_folder = job["folder"] = new_stack_folder()
+        streaming_state["folder"] = stack_folder if streaming_var.get() else None
+        streaming_state["frame_size"] = (image_frame.winfo_width(), image_frame.winfo_height())
         launch_button.config(style="Green.TButton")
-        capture_stack_step(0, num_frames, pre_shot_delay, angle)
+        run_in_background(lambda: engine.run_stack(job), lambda folder: launch_button.config(style="TButton"))
+
+    def auto_plan():
+        # Sweeps the knob while measuring preview sharpness, then captures only the range that comes into focus
+        sweep_range = int(sweep_range_spinbox.get())
+        sweep_step = int(sweep_step_spinbox.get())
+        if camera_preview_active:
+            toggle_camera_preview()
+        auto_plan_button.config(state=tk.DISABLED)
+        run_in_background(lambda: engine.sweep_focus(sweep_range, sweep_step), on_planned)
+
+    def on_planned(plan):
+        auto_plan_button.config(state=tk.NORMAL)
+        if plan is None:
+            print("No focus range found during the sweep")
+            return
+        print(f"Focus from {plan['start']} to {plan['end']} degrees: {plan['frames']} frames every {plan['step']} degrees")
+        frames_spinbox.set(plan["frames"])
+        angle_stacking_spinbox.set(plan["step"])
+        capture_stack(plan["frames"], plan["step"])
 
     def stop_capture_stack():
-        nonlocal stop_capture
-        stop_capture = True
+        engine.stop()
 
     def on_treeview_select(event):
-        selected_item = treeview.selection()[0]
-        parent_item = treeview.parent(selected_item)
-        parent_folder = treeview.item(parent_item, "text")
-        image_name = treeview.item(selected_item, "text")
-        image_path = os.path.join("Capture", parent_folder, image_name)
-        show_full_image(image_path)
-
-    def load_images_from_folder(folder):
-        singles_id = None
-        folder_dict = {}
-        for root, _, files in os.walk(folder):
-            parent_folder = os.path.basename(root)
-            if parent_folder == "Capture":
-                parent_folder = os.path.basename(os.path.dirname(root))
-            if parent_folder not in folder_dict:
-                folder_dict[parent_folder] = []
-            for file in files:
-                if os.path.isfile(os.path.join(root, file)) and file.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.cr2')):
-                    image_path = os.path.join(root, file)
-                    folder_dict[parent_folder].append(image_path)
+        selection = treeview.selection()
+        if selection:
+            image_path = treeview.item_paths.get(selection[0])
+            if image_path:
+                show_full_image(image_path)
+            elif not treeview.parent(selection[0]):
+                show_stack_info(treeview.item(selection[0], "text"))
+
+    def on_treeview_open(event):
+        populate_folder(treeview.focus())
+        schedule_visible_thumbnails()
+
+    def on_treeview_scroll(first, last):
+        treeview.scrollbar.set(first, last)
+        schedule_visible_thumbnails()
+
+    def index_library():
+        # Runs on a worker thread, only folders changed since the last run are listed again
+        engine.catalog.reconcile()
+        return engine.catalog.folder_images()
+
+    def on_library_indexed(folder_dict):
+        fill_tree(folder_dict)
+        library_paths.extend(image_path for image_paths in folder_dict.values() for image_path in image_paths)
+        if current_image_path is None:
+            display_first_image()
+        threading.Thread(target=thumbnail_worker, daemon=True).start()  # Load thumbnails in a separate thread
+        schedule_visible_thumbnails()
+
+    def fill_tree(folder_dict):
+        nonlocal singles_id
         for parent_folder in sorted(folder_dict.keys()):
-            if parent_folder:  # Ensure parent_folder is not empty
-                parent_id = treeview.insert('', 'end', text=parent_folder, open=(parent_folder == "Singles"))
-                treeview.image_dict[parent_folder] = parent_id
-                if parent_folder == "Singles":
-                    singles_id = parent_id
-                for image_path in sorted(folder_dict[parent_folder]):
-                    image_name = os.path.basename(image_path)
-                    new_item = treeview.insert(parent_id, 'end', text=image_name)
-                    treeview.image_thumbnails[new_item] = image_path  # Store the image path temporarily
-        return singles_id
-
-    def load_thumbnails():
-        for item in treeview.image_thumbnails:
-            image_path = treeview.image_thumbnails[item]
-            image = Image.open(image_path)
-            image.thumbnail((50, 50))  # Adjust thumbnail size to fit within the tree view
+            if not parent_folder:  # Ensure parent_folder is not empty
+                continue
+            image_paths = sorted(folder_dict[parent_folder])
+            if parent_folder in treeview.image_dict:  # Frames captured while the library was being indexed
+                parent_id = treeview.image_dict[parent_folder]
+                populate_folder(parent_id)
+                for image_path in image_paths:
+                    if os.path.normpath(image_path) not in treeview.path_index:
+                        insert_image_item(parent_id, image_path)
+            else:
+                parent_id = add_folder_to_treeview(parent_folder, image_paths)
+            if parent_folder == "Singles":
+                singles_id = parent_id
+                populate_folder(parent_id)
+                treeview.item(parent_id, open=True)
+
+    def schedule_filter(event=None):
+        nonlocal filter_timer
+        if filter_timer is not None:
+            window.after_cancel(filter_timer)
+        filter_timer = window.after(200, filter_tree)
+
+    def filter_tree():
+        # Rebuilds the tree from the catalog with the folders matching the filter
+        nonlocal filter_timer, singles_id
+        filter_timer = None
+        treeview.delete(*treeview.get_children())
+        for attribute in (treeview.image_dict, treeview.image_thumbnails, treeview.path_index, treeview.item_paths, treeview.pending_files):
+            attribute.clear()
+        requested_thumbnails.clear()
+        singles_id = None
+        fill_tree(engine.catalog.folder_images(filter_entry.get()))
+        schedule_visible_thumbnails()
+
+    def show_stack_info(folder):
+        stack = engine.catalog.stack(folder)
+        if stack is None:
+            stack_info_label.config(text="")
+            return
+        started = time.strftime("%Y-%m-%d %H:%M", time.localtime(stack["started"]))
+        settings = ", ".join(f"{name} {value}" for name, value in stack["settings"].items())
+        stack_info_label.config(text=f"{started}: {stack['frames']} frames, {stack['angle']}° steps, {stack['delay']:g} s delay\n{settings}")
+
+    def visible_items():
+        items = []
+        for y in range(TREE_ROW_HEIGHT // 2, treeview.winfo_height(), TREE_ROW_HEIGHT):
+            item = treeview.identify_row(y)
+            if item:
+                items.append(item)
+        return items
+
+    def schedule_visible_thumbnails():
+        nonlocal thumbnail_timer
+        if thumbnail_timer is None:
+            thumbnail_timer = window.after(50, load_visible_thumbnails)
+
+    def load_visible_thumbnails():
+        # Rows on screen overtake the rest of their folder, requested when it was opened
+        nonlocal thumbnail_timer
+        thumbnail_timer = None
+        for item in visible_items():
+            image_path = treeview.item_paths.get(item)
+            if image_path is None or item in treeview.image_thumbnails:
+                continue
+            image = thumbnail_cache.get(image_path)
+            if image is not None:
+                set_thumbnail(item, image)
+            else:
+                request_thumbnail(item, image_path, 0)
+
+    def request_thumbnail(item, image_path, priority):
+        if requested_thumbnails.get(item, priority + 1) > priority:  # New, or scrolled into view since requested
+            requested_thumbnails[item] = priority
+            thumbnail_requests.put((priority, next(request_order), item, image_path))
+
+    def set_thumbnail(item, image):
+        if treeview.exists(item):
             photo = ImageTk.PhotoImage(image)
             treeview.item(item, image=photo)
-            treeview.image_thumbnails[item] = photo  # Replace the path with the PhotoImage object
-
-    def load_images_thread():
-        load_thumbnails()
+            treeview.image_thumbnails[item] = photo  # Keep a reference to the PhotoImage object
+
+    def thumbnail_worker():
+        # Hands cache misses to a pool of processes, so decoding scales with cores. Only a few requests are
+        # in flight at once, so rows scrolled into view overtake the ones queued earlier.
+        thumbnail_cache.load()  # One read of the cache instead of decoding every image
+        thumbnail_cache.prune(library_paths)
+        submitted = set()
+        in_flight = {}
+        # Spawned rather than forked, a fork could copy a camera, sqlite or PIL lock held by another thread
+        with ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context("spawn")) as pool:
+            while True:
+                try:
+                    while len(in_flight) < 2 * THUMBNAIL_WORKERS:
+                        _, _, item, image_path = thumbnail_requests.get(block=not in_flight)
+                        if item in submitted:
+                            continue
+                        submitted.add(item)
+                        image = thumbnail_cache.get(image_path)
+                        if image is not None:
+                            thumbnail_results.put((item, image))
+                        else:
+                            in_flight[pool.submit(thumbnail_data, image_path, thumbnail_cache.size)] = (item, image_path)
+                except queue.Empty:
+                    pass
+                done, _ = wait(in_flight, timeout=0.05, return_when=FIRST_COMPLETED)
+                for future in done:
+                    item, image_path = in_flight.pop(future)
+                    try:
+                        data = future.result()
+                        image = decode_thumbnail(data)
+                        thumbnail_cache.put(image_path, image, data)
+                        thumbnail_results.put((item, image))
+                    except Exception as e:
+                        print(f"Failed to create thumbnail for {image_path}: {e}")
+
+    def poll_thumbnails():
+        # PhotoImages are created on the Tk thread, a batch at a time
+        for _ in range(THUMBNAIL_BATCH):
+            try:
+                item, image = thumbnail_results.get_nowait()
+            except queue.Empty:
+                window.after(50, poll_thumbnails)
+                return
+            requested_thumbnails.pop(item, None)
+            set_thumbnail(item, image)
+        window.after(1, poll_thumbnails)  # More are waiting, let Tk handle events before the next batch
 
     def display_first_image():
         if singles_id and treeview.get_children(singles_id):
-            first_image_path = treeview.item(treeview.get_children(singles_id)[0], "text")
-            show_full_image(first_image_path)
-            treeview.selection_set(treeview.get_children(singles_id)[0])
-            treeview.see(treeview.get_children(singles_id)[0])
+            first_item = treeview.get_children(singles_id)[0]
+            show_full_image(treeview.item_paths[first_item])
+            treeview.selection_set(first_item)
+            treeview.see(first_item)
         elif treeview.get_children():
-            first_image_path = treeview.item(treeview.get_children()[0], "text")
-            show_full_image(first_image_path)
-            select_image_in_treeview(first_image_path)
+            # No Singles folder, the first folder is only filled once opened
+            first_folder = treeview.get_children()[0]
+            populate_folder(first_folder)
+            first_items = [item for item in treeview.get_children(first_folder) if item in treeview.item_paths]
+            if first_items:
+                treeview.item(first_folder, open=True)
+                show_full_image(treeview.item_paths[first_items[0]])
+                treeview.selection_set(first_items[0])
+                treeview.see(first_items[0])
 
     def on_resize(event):
         strip_frame.config(width=int(250))
@@ -407,74 +782,96 @@ def main():
         if resize_timer is None:
             resize_timer = window.after(round(100), schedule_final_resize)
 
-    def send_command_to_arduino(command):
-        global arduino
-        if arduino:
-            arduino.write(command.encode())
-        else:
-            print("Arduino not connected")
-
     def move_up():
-        send_command_to_arduino("A")
-        send_command_to_arduino(f"U{angle_spinbox.get()}")
-        send_command_to_arduino("R")
+        engine.send("A")
+        engine.send(f"U{angle_spinbox.get()}")
+        engine.send("R")
 
     def move_down():
-        send_command_to_arduino("A")
-        send_command_to_arduino(f"D{angle_spinbox.get()}")
-        send_command_to_arduino("R")
-
-    def update_ttys():
-        ttys = [f"/dev/{tty}" for tty in os.listdir('/dev') if tty.startswith('tty')]
-        tty_combobox['values'] = ttys
-        if ttys:
-            tty_combobox.set(ttys[-1])  # Set to the last tty in the list
-
-    def connect():
-        global arduino
-        if arduino and arduino.is_open:
-            arduino.close()
-            arduino = None
+        engine.send("A")
+        engine.send(f"D{angle_spinbox.get()}")
+        engine.send("R")
+
+    def set_stepper_connected(connected):
+        if connected:
+            status_label.config(text="Status: Connected", foreground="green")
+            connect_button.config(text="Disconnect")
+            up_button.config(state=tk.NORMAL)
+            down_button.config(state=tk.NORMAL)
+        else:
             status_label.config(text="Status: Unconnected", foreground="red")
             connect_button.config(text="Connect")
             up_button.config(state=tk.DISABLED)
             down_button.config(state=tk.DISABLED)
+
+    def update_ttys():
+        # Probes the USB serial ports in the background for the stepper firmware and connects to it
+        engine.disconnect_stepper()
+        set_stepper_connected(False)
+        tty_combobox['values'] = serial_candidates()
+        status_label.config(text="Status: Searching", foreground="orange")
+        update_button.config(state=tk.DISABLED)
+        connect_button.config(state=tk.DISABLED)
+        baudrate = baudrate_combobox.get()
+        run_in_background(lambda: engine.discover_stepper(baudrate), on_stepper_found)
+
+    def on_stepper_found(tty):
+        update_button.config(state=tk.NORMAL)
+        connect_button.config(state=tk.NORMAL)
+        if tty:
+            tty_combobox.set(tty)
+            set_stepper_connected(True)
+        else:
+            print("No stepper found on the USB serial ports")
+            set_stepper_connected(False)
+
+    def connect():
+        if engine.stepper and engine.stepper.is_open:
+            engine.disconnect_stepper()
+            set_stepper_connected(False)
         else:
             tty = tty_combobox.get()
             baudrate = baudrate_combobox.get()
             try:
-                arduino = serial.Serial(tty, baudrate)
-                status_label.config(text="Status: Connected", foreground="green")
-                connect_button.config(text="Disconnect")
-                up_button.config(state=tk.NORMAL)
-                down_button.config(state=tk.NORMAL)
+                engine.connect_stepper(tty, baudrate)
+                set_stepper_connected(True)
             except Exception as e:
                 print(f"Failed to connect: {e}")
-                status_label.config(text="Status: Unconnected", foreground="red")
+                set_stepper_connected(False)
 
-    def populate_combobox(widget_name, combobox):
+    def start_camera():
+        # Runs on a worker thread: the gphoto2 init and the first config read take seconds on some bodies
+        if not engine.camera.connect():
+            return False, None
         try:
-            OK, widget = gp.gp_widget_get_child_by_name(config, widget_name)
-            if OK >= gp.GP_OK:
-                values = [gp.gp_widget_get_choice(widget, i)[1] for i in range(gp.gp_widget_count_choices(widget))]
-                combobox['values'] = values
-                current_value = gp.gp_widget_get_value(widget)[1]
-                combobox.set(current_value)
+            return True, CameraSettings(engine.camera.camera, engine.camera.lock, tuple(setting_comboboxes), engine.stacking)
         except gp.GPhoto2Error as e:
-            print(f"Failed to get {widget_name} values: {e}")
-        except Exception as e:
-            print(f"Unexpected error: {e}")
+            print(f"Failed to read camera settings: {e}")
+            return True, None
+
+    def on_camera_ready(result):
+        nonlocal camera_settings
+        camera_connected, camera_settings = result
+        if not camera_connected:
+            print("Camera controls disabled due to no camera connection")
+            return
+        for control in camera_controls:
+            control.config(state=tk.NORMAL)
+        for widget_name, combobox in setting_comboboxes.items():
+            populate_combobox(widget_name, combobox)
+
+    def populate_combobox(widget_name, combobox):
+        if camera_settings is None:
+            return
+        current_value, values = camera_settings.get(widget_name)
+        combobox['values'] = values
+        if current_value is not None:
+            combobox.set(current_value)
 
     def set_camera_value(event, widget_name, combobox):
-        try:
-            OK, widget = gp.gp_widget_get_child_by_name(config, widget_name)
-            if OK >= gp.GP_OK:
-                widget.set_value(combobox.get())
-                camera.set_config(config)
-        except gp.GPhoto2Error as e:
-            print(f"Failed to set {widget_name} value: {e}")
-        except Exception as e:
-            print(f"Unexpected error: {e}")
+        # Queued and written by the settings worker, so the UI and preview are not held up by the camera
+        if camera_settings is not None:
+            camera_settings.set(widget_name, combobox.get())
 
     # Add Shutter Speed control
     shutter_speed_label = create_label(camera_frame, "Shutter Speed: ", row=2, column=0)
@@ -497,10 +894,7 @@ def main():
     white_balance_combobox.bind("<<ComboboxSelected>>", lambda event: set_camera_value(event, 'whitebalance', white_balance_combobox))
     image_format_combobox.bind("<<ComboboxSelected>>", lambda event: set_camera_value(event, 'imageformat', image_format_combobox))
 
-    populate_combobox('iso', iso_combobox)
-    populate_combobox('shutterspeed', shutter_speed_combobox)
-    populate_combobox('whitebalance', white_balance_combobox)
-    populate_combobox('imageformat', image_format_combobox)
+    setting_comboboxes = {'iso': iso_combobox, 'shutterspeed': shutter_speed_combobox, 'whitebalance': white_balance_combobox, 'imageformat': image_format_combobox}
 
     capture_button = ttk.Button(camera_frame, text="Capture", command=capture_and_process_image, width=15)
     capture_button.grid(row=0, column=0, columnspan=2, pady=5, sticky=tk.W+tk.E)
@@ -508,6 +902,9 @@ def main():
     camera_button = ttk.Button(camera_frame, text="Start Preview", command=toggle_camera_preview, width=15)
     camera_button.grid(row=1, column=0, columnspan=2, pady=5, sticky=tk.W+tk.E)
 
+    preview_stats_label = ttk.Label(camera_frame, text="Preview: -", anchor=tk.W)
+    preview_stats_label.grid(row=6, column=0, columnspan=2, pady=5, sticky=tk.W)
+
     update_button = ttk.Button(connection_frame, text="Update TTY", command=update_ttys)
     update_button.grid(row=0, column=0, columnspan=2, pady=5, sticky=tk.W+tk.E)
 
@@ -523,9 +920,6 @@ def main():
     status_label = ttk.Label(connection_frame, text="Status: Unconnected", foreground="red", anchor=tk.E)
     status_label.grid(row=4, column=0, columnspan=2, pady=5)
 
-    update_ttys()  # Update the list of TTYs at app initialization
-    window.after(1000, connect)  # Try to connect to the selected TTY after updating the list
-
     angle_label = create_label(manual_controls_frame, "Angle (degrees): ", row=0, column=0)
     angle_spinbox = create_spinbox(manual_controls_frame, from_=0, to=360, row=0, column=1, default_value=15)
 
@@ -543,33 +937,82 @@ def main():
     pre_shot_delay_label = create_label(stacking_frame, "Pre-Shot Delay: ", row=1, column=0)
     pre_shot_delay_spinbox = create_spinbox(stacking_frame, from_=0, to=60, row=1, column=1, default_value=1)
 
+    settle_var = tk.BooleanVar(value=False)
+    settle_checkbutton = ttk.Checkbutton(stacking_frame, text="Shoot once still (delay is the limit)", variable=settle_var)
+    settle_checkbutton.grid(row=2, column=0, columnspan=2, pady=5, sticky=tk.W)
+
     angle_stacking_label = create_label(stacking_frame, "Angle (degrees): ", row=3, column=0)
     angle_stacking_spinbox = create_spinbox(stacking_frame, from_=0, to=360, row=3, column=1, default_value=30)
 
+    pipelined_var = tk.BooleanVar(value=True)
+    pipelined_checkbutton = ttk.Checkbutton(stacking_frame, text="Download while moving", variable=pipelined_var)
+    pipelined_checkbutton.grid(row=4, column=0, columnspan=2, pady=5, sticky=tk.W)
+
+    streaming_var = tk.BooleanVar(value=False)
+    streaming_checkbutton = ttk.Checkbutton(stacking_frame, text="Stack while capturing", variable=streaming_var)
+    streaming_checkbutton.grid(row=5, column=0, columnspan=2, pady=5, sticky=tk.W)
+
+    burst_var = tk.BooleanVar(value=False)
+    burst_checkbutton = ttk.Checkbutton(stacking_frame, text="Capture to card, transfer at the end", variable=burst_var)
+    burst_checkbutton.grid(row=6, column=0, columnspan=2, pady=5, sticky=tk.W)
+
     launch_button = ttk.Button(stacking_frame, text="Capture Stack", command=capture_stack, width=15)
-    launch_button.grid(row=4, column=0, columnspan=2, pady=5, sticky=tk.W+tk.E)
+    launch_button.grid(row=7, column=0, columnspan=2, pady=5, sticky=tk.W+tk.E)
 
     stop_button = ttk.Button(stacking_frame, text="Stop", command=stop_capture_stack, width=15)
-    stop_button.grid(row=5, column=0, columnspan=2, pady=5, sticky=tk.W+tk.E)
+    stop_button.grid(row=8, column=0, columnspan=2, pady=5, sticky=tk.W+tk.E)
+
+    alignment_label = ttk.Label(stacking_frame, text="Drift: -", anchor=tk.W)
+    alignment_label.grid(row=9, column=0, columnspan=2, pady=5, sticky=tk.W)
+
+    sweep_range_label = create_label(stacking_frame, "Sweep (degrees): ", row=10, column=0)
+    sweep_range_spinbox = create_spinbox(stacking_frame, from_=10, to=3600, row=10, column=1, increment=10, default_value=360)
+
+    sweep_step_label = create_label(stacking_frame, "Sweep Step: ", row=11, column=0)
+    sweep_step_spinbox = create_spinbox(stacking_frame, from_=1, to=360, row=11, column=1, default_value=10)
+
+    auto_plan_button = ttk.Button(stacking_frame, text="Auto Plan Stack", command=auto_plan, width=15)
+    auto_plan_button.grid(row=12, column=0, columnspan=2, pady=5, sticky=tk.W+tk.E)
+
+    stack_button = ttk.Button(strip_frame, text="Stack", command=stack_selected_folders)
+    stack_button.pack(side=tk.TOP, fill=tk.X, pady=5, before=treeview)
+
+    filter_entry = ttk.Entry(strip_frame)
+    filter_entry.pack(side=tk.TOP, fill=tk.X, pady=5, before=treeview)
+    filter_entry.bind("<KeyRelease>", schedule_filter)
+
+    stack_info_label = ttk.Label(strip_frame, text="", anchor=tk.W, wraplength=230)
+    stack_info_label.pack(side=tk.TOP, fill=tk.X, before=treeview)
 
     treeview.bind("<<TreeviewSelect>>", on_treeview_select)
+    treeview.bind("<<TreeviewOpen>>", on_treeview_open)
+    treeview.bind("<Configure>", lambda event: schedule_visible_thumbnails())
+    treeview.configure(yscrollcommand=on_treeview_scroll)
 
-    singles_id = load_images_from_folder("Capture")  # Load image names in the main thread
-    display_first_image()
-    threading.Thread(target=load_images_thread).start()  # Load thumbnails in a separate thread
+    poll_thumbnails()
 
     window.bind("<Configure>", on_resize)  # Bind the resize event to update the image size
 
-    if not camera_connected:
-        camera_button.config(state=tk.DISABLED)
-        capture_button.config(state=tk.DISABLED)
-        shutter_speed_combobox.config(state=tk.DISABLED)
-        iso_combobox.config(state=tk.DISABLED)
-        white_balance_combobox.config(state=tk.DISABLED)
-        image_format_combobox.config(state=tk.DISABLED)
-        launch_button.config(state=tk.DISABLED)
-        stop_button.config(state=tk.DISABLED)
-        print("Camera controls disabled due to no camera connection")
+    # Wheel zoom, drag pan and double click 100% on the canvas, back to the fitted rendition when zoomed out
+    zoom_view = ZoomView(full_image_canvas, TileStore(os.path.join(CAPTURE_FOLDER, ".tiles.sqlite")), display_image,
+                         lambda: current_image_path and display_rendition(current_image_path))
+
+    engine.download_listeners.append(on_frame_downloaded)
+    engine.frame_listeners.append(on_frame_saved)
+    engine.stack_listeners.append(on_stack_saved)
+    threading.Thread(target=prefetch_worker, daemon=True).start()
+    threading.Thread(target=streaming_worker, daemon=True).start()
+    threading.Thread(target=alignment_worker, daemon=True).start()
+    poll_completed_frames()
+
+    # The window is shown right away, camera, stepper and library come up in the background and
+    # their controls are enabled as each one is ready
+    camera_controls = [camera_button, capture_button, shutter_speed_combobox, iso_combobox, white_balance_combobox, image_format_combobox, launch_button, stop_button, auto_plan_button]
+    for control in camera_controls:
+        control.config(state=tk.DISABLED)
+    run_in_background(start_camera, on_camera_ready)
+    update_ttys()
+    run_in_background(index_library, on_library_indexed)
 
     window.mainloop()
 
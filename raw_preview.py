@@ -0,0 +1,149 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# CR2 files are TIFF containers: IFD0 holds a full-size JPEG preview in its strips and IFD1 the
+# EXIF thumbnail. Both are read with a few seeks, without touching the sensor data in the last IFD.
+
+from PIL import Image
+import io
+import struct
+
+RAW_EXTENSIONS = ('.cr2',)
+
+TAG_STRIP_OFFSETS = 0x0111
+TAG_ORIENTATION = 0x0112
+TAG_STRIP_BYTE_COUNTS = 0x0117
+TAG_JPEG_OFFSET = 0x0201
+TAG_JPEG_LENGTH = 0x0202
+
+TYPE_SIZES = {1: 1, 3: 2, 4: 4}  # BYTE, SHORT, LONG
+TYPE_FORMATS = {1: "B", 3: "H", 4: "I"}
+
+ORIENTATION_TRANSPOSE = {3: Image.ROTATE_180, 6: Image.ROTATE_270, 8: Image.ROTATE_90}
+
+class MemoryFile:
+    # Read-only file over a buffer such as the memoryview of a download, io.BytesIO would copy it whole
+    def __init__(self, data):
+        self.data = memoryview(data).cast("B")
+        self.position = 0
+
+    def read(self, size=-1):
+        end = len(self.data) if size is None or size < 0 else min(len(self.data), self.position + size)
+        chunk = self.data[self.position:end].tobytes()
+        self.position = max(self.position, end)
+        return chunk
+
+    def seek(self, offset, whence=0):
+        self.position = max(0, offset + (0, self.position, len(self.data))[whence])
+        return self.position
+
+    def tell(self):
+        return self.position
+
+def is_raw(image_path):
+    return image_path.lower().endswith(RAW_EXTENSIONS)
+
+def read_ifd(file, offset, endian):
+    file.seek(offset)
+    (count,) = struct.unpack(endian + "H", file.read(2))
+    entries = file.read(12 * count)
+    (next_offset,) = struct.unpack(endian + "I", file.read(4))
+    tags = {}
+    for i in range(count):
+        tag, value_type, value_count, value = struct.unpack(endian + "HHI4s", entries[12 * i:12 * i + 12])
+        if value_type not in TYPE_SIZES:
+            continue
+        size = TYPE_SIZES[value_type] * value_count
+        if size > 4:
+            continue  # Only single values are needed, arrays stored elsewhere in the file are skipped
+        tags[tag] = struct.unpack(endian + TYPE_FORMATS[value_type] * value_count, value[:size])
+    return tags, next_offset
+
+def read_preview_ranges(file):
+    # Returns ((offset, length) of the full-size preview, (offset, length) of the thumbnail, orientation)
+    header = file.read(16)
+    if header[:4] not in (b"II*\x00", b"MM\x00*") or header[8:10] != b"CR":
+        return None, None, 1
+    endian = "<" if header[:2] == b"II" else ">"
+    (ifd0_offset,) = struct.unpack(endian + "I", header[4:8])
+    ifd0, ifd1_offset = read_ifd(file, ifd0_offset, endian)
+    preview = None
+    if TAG_STRIP_OFFSETS in ifd0 and TAG_STRIP_BYTE_COUNTS in ifd0:
+        preview = (ifd0[TAG_STRIP_OFFSETS][0], ifd0[TAG_STRIP_BYTE_COUNTS][0])
+    orientation = ifd0.get(TAG_ORIENTATION, (1,))[0]
+    thumbnail = None
+    if ifd1_offset:
+        ifd1, _ = read_ifd(file, ifd1_offset, endian)
+        if TAG_JPEG_OFFSET in ifd1 and TAG_JPEG_LENGTH in ifd1:
+            thumbnail = (ifd1[TAG_JPEG_OFFSET][0], ifd1[TAG_JPEG_LENGTH][0])
+    return preview, thumbnail, orientation
+
+def read_range(file, byte_range):
+    offset, length = byte_range
+    file.seek(offset)
+    data = file.read(length)
+    if data[:2] != b"\xff\xd8":  # Not a JPEG stream
+        return None
+    return data
+
+def open_raw_preview(image_path, size=None):
+    with open(image_path, "rb") as file:
+        return read_raw_preview(file, size)
+
+def read_raw_preview(file, size=None):
+    # Smallest embedded JPEG that still covers size, the full-size preview when size is None
+    preview, thumbnail, orientation = read_preview_ranges(file)
+    image = None
+    if thumbnail and size:
+        data = read_range(file, thumbnail)
+        if data:
+            image = Image.open(io.BytesIO(data))
+            if image.width < size[0] and image.height < size[1]:
+                image = None
+    if image is None and preview:
+        data = read_range(file, preview)
+        if data:
+            image = Image.open(io.BytesIO(data))
+    if image is None:
+        return None
+    if size:
+        image.draft("RGB", size)
+    if orientation in ORIENTATION_TRANSPOSE:
+        image = image.transpose(ORIENTATION_TRANSPOSE[orientation])
+    return image
+
+def open_image(image_path, size=None):
+    # Like Image.open, but RAW files are served from their embedded previews
+    if is_raw(image_path):
+        try:
+            image = open_raw_preview(image_path, size)
+            if image is not None:
+                return image
+        except (OSError, struct.error) as e:
+            print(f"Failed to read embedded preview of {image_path}: {e}")
+    return Image.open(image_path)
+
+def open_image_data(data, image_path, size=None):
+    # Same as open_image for a file still in memory, image_path only tells the format
+    if is_raw(image_path):
+        try:
+            image = read_raw_preview(MemoryFile(data), size)
+            if image is not None:
+                return image
+        except (OSError, struct.error) as e:
+            print(f"Failed to read embedded preview of {image_path}: {e}")
+    return Image.open(MemoryFile(data))
@@ -0,0 +1,177 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Several camera + stepper rigs driven from one process. Each rig has its own Engine, so its own capture,
+# download and save threads, plus a job thread, and stacks on different rigs run concurrently. The rigs share
+# the catalog and a single stacking queue, as each stack already uses every core.
+#
+# The rigs file is a JSON list such as
+# [{"name": "left", "camera_port": "usb:001,005", "tty": "/dev/ttyACM0", "jobs": ["50:30:1"]},
+#  {"name": "right", "camera_serial": "083021001234", "tty": "/dev/ttyACM1", "jobs": [{"frames": 80, "angle": 20}]}]
+
+import argparse
+import json
+import os
+import queue
+import threading
+import gphoto2 as gp
+from catalog import Catalog
+from engine import Engine, Camera, StepperChannel, list_cameras, parse_job, CAPTURE_FOLDER
+import stacking
+
+def open_camera(port=None, serial=None):
+    # Connected camera at port, or the detected camera with that serial number, or None
+    if serial is None:
+        camera = Camera(port)
+        return camera if camera.connect() else None
+    for model, camera_port in list_cameras():
+        camera = Camera(camera_port)
+        if not camera.connect():
+            continue
+        try:
+            if camera.serial_number() == serial:
+                return camera
+        except gp.GPhoto2Error as e:
+            print(f"Failed to read the serial number of the {model} at {camera_port}: {e}")
+        camera.close()
+    print(f"No camera with serial number {serial}")
+    return None
+
+class StackingQueue:
+    # Stacks folders one at a time on a worker thread, whichever rig captured them
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.folders = queue.Queue()
+        threading.Thread(target=self.run, name="stacking", daemon=True).start()
+
+    def submit(self, folder_path):
+        self.folders.put(folder_path)
+
+    def run(self):
+        while True:
+            folder_path = self.folders.get()
+            try:
+                self.catalog.add_image(stacking.stack_folder(folder_path))
+            except Exception as e:
+                print(f"Failed to stack {folder_path}: {e}")
+            finally:
+                self.folders.task_done()
+
+    def join(self):
+        self.folders.join()
+
+class Rig:
+    def __init__(self, name, camera, stepper, catalog, stacker, capture_folder=CAPTURE_FOLDER):
+        self.name = name
+        self.engine = Engine(camera, capture_folder, catalog, name=name)
+        self.engine.stepper = stepper
+        self.stacker = stacker
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=f"{name} jobs", daemon=True)
+        self.thread.start()
+
+    def submit(self, job, stack=False):
+        self.jobs.put((job, stack))
+
+    def run(self):
+        while True:
+            job, stack = self.jobs.get()
+            try:
+                print(f"{self.name}: {job}")
+                folder = self.engine.run_job(job)
+                if folder and stack:
+                    self.stacker.submit(os.path.join(self.engine.capture_folder, folder))
+            except Exception as e:
+                print(f"{self.name}: job failed: {e}")
+            finally:
+                self.jobs.task_done()
+
+    def join(self):
+        self.jobs.join()
+
+    def stop(self):
+        while not self.jobs.empty():  # Drop the jobs not started yet
+            try:
+                self.jobs.get_nowait()
+                self.jobs.task_done()
+            except queue.Empty:
+                break
+        self.engine.stop()
+
+    def close(self):
+        self.engine.disconnect_stepper()
+        self.engine.camera.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Capture focus stacks on several camera and stepper rigs at once")
+    parser.add_argument("rigs_file", nargs="?", help="JSON list of rigs with name, camera_port or camera_serial, tty, baudrate and jobs")
+    parser.add_argument("--stack", action="store_true", help="Focus stack every folder once captured")
+    parser.add_argument("--burst", action="store_true", help="Keep frames on the card during each stack and transfer them at the end")
+    parser.add_argument("--settle", action="store_true", help="Shoot as soon as the preview is still, the delay being the upper bound")
+    parser.add_argument("--list-cameras", action="store_true", help="Print the model and port of every camera found and exit")
+    args = parser.parse_args()
+
+    if args.list_cameras:
+        for model, port in list_cameras():
+            print(f"{port}\t{model}")
+        return
+    if args.rigs_file is None:
+        parser.error("no rigs file given")
+    with open(args.rigs_file) as file:
+        configs = json.load(file)
+    os.makedirs(CAPTURE_FOLDER, exist_ok=True)
+    catalog = Catalog(CAPTURE_FOLDER)
+    stacker = StackingQueue(catalog)
+    rigs = []
+    try:
+        for index, config in enumerate(configs):
+            # A rig that cannot start is skipped, the others still run
+            if "name" not in config or "tty" not in config:
+                print(f"Skipping rig {index + 1}, it needs a name and a tty")
+                continue
+            camera = open_camera(config.get("camera_port"), config.get("camera_serial"))
+            if camera is None:
+                print(f"Skipping rig {config['name']}, its camera was not found")
+                continue
+            try:
+                stepper = StepperChannel(config["tty"], config.get("baudrate", "9600"))
+            except Exception as e:
+                print(f"Skipping rig {config['name']}, failed to open {config['tty']}: {e}")
+                camera.close()
+                continue
+            rig = Rig(config["name"], camera, stepper, catalog, stacker)
+            rigs.append(rig)
+            for job in config.get("jobs", []):
+                job = parse_job(job) if isinstance(job, str) else job
+                rig.submit(
+                    dict(job, burst=job.get("burst", args.burst), settle=job.get("settle", args.settle)),
+                    job.get("stack", args.stack),
+                )
+        for rig in rigs:
+            rig.join()
+        stacker.join()
+    except KeyboardInterrupt:
+        for rig in rigs:
+            rig.stop()
+        for rig in rigs:
+            rig.join()  # The running stacks end at their next frame
+    finally:
+        for rig in rigs:
+            rig.close()
+
+if __name__ == "__main__":
+    main()
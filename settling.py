@@ -0,0 +1,34 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Settle detection after a move: small preview frames are compared until the image stops moving, so the
+# shutter fires as soon as vibrations have died down instead of after a fixed delay.
+
+import numpy as np
+from image_cache import decode_preview
+
+SETTLE_SIZE = (160, 160)  # Preview frames are compared at this size, which also averages out sensor noise
+SETTLE_THRESHOLD = 1.0  # Mean absolute luma difference between two previews, in grey levels, below which the image is still
+SETTLE_TIME = 0.2  # Seconds the image must stay still before the shutter is released
+
+def preview_luma(file_data, size=SETTLE_SIZE):
+    return np.asarray(decode_preview(file_data, size).convert("L"), dtype=np.float32)
+
+def motion_energy(previous, current):
+    if previous.shape != current.shape:
+        return float("inf")
+    return float(np.abs(current - previous).mean())
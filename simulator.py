@@ -0,0 +1,195 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Stand-ins for the camera and the stepper so the capture loop can be run and measured without hardware.
+# FakeCamera has the interface of engine.Camera, FakeStepperPort is a serial port speaking the firmware protocol.
+
+from PIL import Image
+import io
+import numpy as np
+import os
+import queue
+import re
+import struct
+import threading
+import time
+from engine import StepperChannel, STEPPER_RPM
+from tracing import tracer
+
+class FakeFilePath:
+    def __init__(self, folder, name):
+        self.folder = folder
+        self.name = name
+
+def synthetic_jpeg(size, seed=0, quality=90):
+    # Smooth pattern plus noise, so the file size and decode time are close to a real photograph
+    width, height = size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    pattern = 127 + 60 * np.sin(x / 37 + seed) * np.cos(y / 23)
+    pixels = pattern[..., None] + rng.normal(0, 20, (height, width, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+def synthetic_cr2(preview_jpeg, thumbnail_jpeg, raw_bytes):
+    # Minimal CR2 layout: IFD0 points at the full-size preview, IFD1 at the EXIF thumbnail, then sensor data
+    def entry(tag, value):
+        return struct.pack("<HHII", tag, 4, 1, value)
+    ifd0_offset = 16
+    ifd1_offset = ifd0_offset + 2 + 2 * 12 + 4
+    thumbnail_offset = ifd1_offset + 2 + 2 * 12 + 4
+    preview_offset = thumbnail_offset + len(thumbnail_jpeg)
+    header = b"II*\x00" + struct.pack("<I", ifd0_offset) + b"CR\x02\x00" + struct.pack("<I", 0)
+    ifd0 = struct.pack("<H", 2) + entry(0x0111, preview_offset) + entry(0x0117, len(preview_jpeg)) + struct.pack("<I", ifd1_offset)
+    ifd1 = struct.pack("<H", 2) + entry(0x0201, thumbnail_offset) + entry(0x0202, len(thumbnail_jpeg)) + struct.pack("<I", 0)
+    return header + ifd0 + ifd1 + thumbnail_jpeg + preview_jpeg + os.urandom(raw_bytes)
+
+class FakeCamera:
+    # Serves the same synthetic payload for every capture with realistic trigger, transfer and preview latencies
+    def __init__(self, image_format="jpeg", size=(3000, 2000), raw_megabytes=25, capture_latency=0.25,
+                 usb_megabytes_per_second=30, preview_latency=0.04, preview_size=(960, 640)):
+        self.camera = None
+        self.connected = False
+        self.lock = threading.Lock()
+        self.capture_latency = capture_latency
+        self.bytes_per_second = usb_megabytes_per_second * 1024 * 1024
+        self.preview_latency = preview_latency
+        jpeg = synthetic_jpeg(size)
+        if image_format == "raw":
+            self.payload = synthetic_cr2(jpeg, synthetic_jpeg((160, 120)), raw_megabytes * 1024 * 1024)
+            self.extension = "CR2"
+        else:
+            self.payload = jpeg
+            self.extension = "JPG"
+        self.preview = synthetic_jpeg(preview_size, quality=75)
+        self.count = 0
+        self.trigger_times = {}  # File name -> time the shutter was released
+        self.config = {"capturetarget": "Internal RAM"}
+
+    def connect(self):
+        self.connected = True
+        return True
+
+    def close(self):
+        self.connected = False
+
+    def capture(self):
+        with self.lock, tracer.span("capture"):
+            time.sleep(self.capture_latency)
+            self.count += 1
+            file_path = FakeFilePath("/store_00010001/DCIM/100CANON", f"IMG_{self.count:04d}.{self.extension}")
+            self.trigger_times[file_path.name] = time.time()
+        return file_path
+
+    def download(self, file_path):
+        with self.lock, tracer.span("download", file=file_path.name):
+            time.sleep(len(self.payload) / self.bytes_per_second)
+        return self.payload
+
+    def file_size(self, file_path):
+        return len(self.payload)
+
+    def delete(self, file_path):
+        pass  # Captures are not stored, every download serves the same payload
+
+    def set_config(self, name, value):
+        previous = self.config.get(name)
+        self.config[name] = value
+        return previous
+
+    def capture_preview(self):
+        with self.lock, tracer.span("capture", category="preview"):
+            time.sleep(self.preview_latency)
+        return self.preview
+
+MOVE_PATTERN = re.compile(rb"[UD]([^0-9]*)([0-9]*)")  # parseInt skips whatever comes before the digits
+
+class FakeStepperPort:
+    # Serial port implementing the firmware protocol: A/R enable and release the motor, U<n>/D<n> rotate
+    # by n degrees at the firmware speed and answer OK once the move is over, I answers the identity
+    def __init__(self, rpm=STEPPER_RPM):
+        self.rpm = rpm
+        self.is_open = True
+        self.enabled = False
+        self.position = 0
+        self.buffer = b""
+        self.buffer_lock = threading.Lock()
+        self.commands = queue.Queue()
+        self.lines = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def write(self, data):
+        with self.buffer_lock:
+            self.buffer += data
+            self.parse()
+        return len(data)
+
+    def parse(self):
+        while self.buffer:
+            command = self.buffer[:1]
+            if command in (b"A", b"R", b"I"):
+                self.commands.put((command.decode(), 0))
+                self.buffer = self.buffer[1:]
+            elif command in (b"U", b"D"):
+                move = MOVE_PATTERN.match(self.buffer)
+                if not move.group(2) or move.end() == len(self.buffer):
+                    break  # Wait for the end of the number, like Serial.parseInt
+                self.commands.put((command.decode(), int(move.group(2))))
+                self.buffer = self.buffer[move.end():]
+            else:
+                self.buffer = self.buffer[1:]
+
+    def flush_pending(self):
+        # The firmware's parseInt times out after 10 ms, so a trailing number is complete by then,
+        # and a move without one, such as "U\n", rotates by 0 and is still acknowledged
+        with self.buffer_lock:
+            if self.buffer[:1] in (b"U", b"D"):
+                move = MOVE_PATTERN.match(self.buffer)
+                self.commands.put((self.buffer[:1].decode(), int(move.group(2) or 0)))
+                self.buffer = self.buffer[move.end():]
+                self.parse()
+
+    def run(self):
+        while self.is_open:
+            try:
+                command, value = self.commands.get(timeout=0.01)
+            except queue.Empty:
+                self.flush_pending()
+                continue
+            if command == "A":
+                self.enabled = True
+            elif command == "R":
+                self.enabled = False
+            elif command == "I":
+                self.lines.put(b"MICROSTACKING\r\n")
+            else:
+                time.sleep(value / 360 * 60 / self.rpm)
+                self.position += value if command == "U" else -value
+                self.lines.put(b"OK\r\n")
+
+    def readline(self):
+        try:
+            return self.lines.get(timeout=0.1)
+        except queue.Empty:
+            return b""
+
+    def close(self):
+        self.is_open = False
+
+def fake_stepper(rpm=STEPPER_RPM):
+    return StepperChannel(None, None, port=FakeStepperPort(rpm))
@@ -0,0 +1,180 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Depth-map focus stacking: every output pixel is taken from the frame with the highest local
+# Laplacian energy. Frames are decoded once into a memory-mapped staging array, then tiles are
+# processed in a process pool so memory stays bounded by the tile size whatever the frame size.
+
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import multiprocessing
+import numpy as np
+import os
+import tempfile
+import time
+from image_cache import IMAGE_EXTENSIONS
+from raw_preview import open_image
+
+STACKED_FOLDER = os.path.join("Capture", "Stacked")
+TILE_SIZE = 512
+FOCUS_RADIUS = 4  # Half size of the window the Laplacian energy is averaged over
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+def list_frames(folder):
+    return sorted(
+        os.path.join(folder, file) for file in os.listdir(folder)
+        if file.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(os.path.join(folder, file))
+    )
+
+def box_filter(values, radius):
+    # Mean over a (2 * radius + 1) square window using an integral image, edges are replicated
+    size = 2 * radius + 1
+    padded = np.pad(values.astype(np.float64), radius, mode="edge")
+    integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1))
+    integral[1:, 1:] = padded.cumsum(0).cumsum(1)
+    window = integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+    return (window / (size * size)).astype(np.float32)
+
+def focus_energy(rgb, radius=FOCUS_RADIUS):
+    gray = rgb.astype(np.float32) @ LUMA
+    laplacian = np.zeros_like(gray)
+    laplacian[1:-1, 1:-1] = (
+        4 * gray[1:-1, 1:-1] - gray[:-2, 1:-1] - gray[2:, 1:-1] - gray[1:-1, :-2] - gray[1:-1, 2:]
+    )
+    return box_filter(laplacian * laplacian, radius)
+
+def decode_frame(args):
+    index, image_path, stage_path = args
+    frames = np.lib.format.open_memmap(stage_path, mode="r+")
+    image = open_image(image_path).convert("RGB")
+    if (image.height, image.width) != frames.shape[1:3]:
+        raise ValueError(f"{image_path} is {image.width}x{image.height}, expected {frames.shape[2]}x{frames.shape[1]}")
+    frames[index] = np.asarray(image)
+    frames.flush()
+
+def stack_tile(args):
+    stage_path, result_path, y0, y1, x0, x1, radius = args
+    frames = np.lib.format.open_memmap(stage_path, mode="r")
+    count, height, width, _ = frames.shape
+    margin = radius + 1  # Enough context for the Laplacian and the box filter at the tile edges
+    ty0, ty1 = max(0, y0 - margin), min(height, y1 + margin)
+    tx0, tx1 = max(0, x0 - margin), min(width, x1 + margin)
+    best_energy = None
+    for index in range(count):
+        energy = focus_energy(frames[index, ty0:ty1, tx0:tx1], radius)
+        if best_energy is None:
+            best_energy = energy
+            best_index = np.zeros(energy.shape, dtype=np.uint16)
+        else:
+            better = energy > best_energy
+            best_energy = np.where(better, energy, best_energy)
+            best_index[better] = index
+    best_index = best_index[y0 - ty0:y1 - ty0, x0 - tx0:x1 - tx0]
+    tile = np.empty((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+    for index in np.unique(best_index):
+        mask = best_index == index
+        tile[mask] = frames[index, y0:y1, x0:x1][mask]
+    result = np.lib.format.open_memmap(result_path, mode="r+")
+    result[y0:y1, x0:x1] = tile
+    result.flush()
+
+def stack_images(image_paths, output_path, tile_size=TILE_SIZE, radius=FOCUS_RADIUS, workers=None):
+    width, height = open_image(image_paths[0]).size
+    output_folder = os.path.dirname(output_path) or "."
+    os.makedirs(output_folder, exist_ok=True)
+    start_time = time.time()
+    # Staging next to the output keeps the decoded frames on the same disk rather than in RAM
+    with tempfile.TemporaryDirectory(dir=output_folder) as staging:
+        stage_path = os.path.join(staging, "frames.npy")
+        result_path = os.path.join(staging, "result.npy")
+        np.lib.format.open_memmap(stage_path, mode="w+", dtype=np.uint8, shape=(len(image_paths), height, width, 3))
+        np.lib.format.open_memmap(result_path, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+        tiles = [
+            (stage_path, result_path, y, min(y + tile_size, height), x, min(x + tile_size, width), radius)
+            for y in range(0, height, tile_size) for x in range(0, width, tile_size)
+        ]
+        # Spawned rather than forked, a fork could copy a camera, serial or sqlite lock held by another thread
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            list(pool.map(decode_frame, [(index, image_path, stage_path) for index, image_path in enumerate(image_paths)]))
+            list(pool.map(stack_tile, tiles))
+        result = np.lib.format.open_memmap(result_path, mode="r")
+        Image.fromarray(np.asarray(result)).save(output_path)
+    print(f"Stacked {len(image_paths)} frames into {output_path} in {time.time() - start_time:.1f} seconds")
+    return output_path
+
+class StreamingStacker:
+    # Folds frames in one at a time, keeping only the sharpest pixels seen so far and the frame they came from,
+    # so memory does not grow with the number of frames. Bands are processed on threads as NumPy releases the GIL.
+    def __init__(self, radius=FOCUS_RADIUS, band_height=TILE_SIZE, workers=None):
+        self.radius = radius
+        self.band_height = band_height
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.count = 0
+        self.composite = None
+        self.best_energy = None
+        self.best_index = None
+
+    def add_frame(self, image):
+        rgb = np.asarray(image.convert("RGB"))
+        if self.composite is None:
+            self.composite = rgb.copy()
+            self.best_energy = np.zeros(rgb.shape[:2], dtype=np.float32)
+            self.best_index = np.zeros(rgb.shape[:2], dtype=np.uint16)
+        elif rgb.shape != self.composite.shape:
+            raise ValueError(f"Frame is {rgb.shape[1]}x{rgb.shape[0]}, expected {self.composite.shape[1]}x{self.composite.shape[0]}")
+        list(self.pool.map(lambda y: self.fold_band(rgb, y), range(0, rgb.shape[0], self.band_height)))
+        self.count += 1
+
+    def fold_band(self, rgb, y0):
+        height = rgb.shape[0]
+        y1 = min(y0 + self.band_height, height)
+        margin = self.radius + 1
+        ty0, ty1 = max(0, y0 - margin), min(height, y1 + margin)
+        energy = focus_energy(rgb[ty0:ty1], self.radius)[y0 - ty0:y1 - ty0]
+        if self.count == 0:
+            self.best_energy[y0:y1] = energy
+            return
+        better = energy > self.best_energy[y0:y1]
+        np.copyto(self.best_energy[y0:y1], energy, where=better)
+        self.best_index[y0:y1][better] = self.count
+        self.composite[y0:y1][better] = rgb[y0:y1][better]
+
+    def result(self):
+        return Image.fromarray(self.composite)
+
+    def close(self):
+        self.pool.shutdown()
+
+def stack_folder(folder, output_path=None, tile_size=TILE_SIZE, radius=FOCUS_RADIUS, workers=None):
+    image_paths = list_frames(folder)
+    if not image_paths:
+        raise ValueError(f"No images found in {folder}")
+    if output_path is None:
+        output_path = os.path.join(STACKED_FOLDER, os.path.basename(os.path.normpath(folder)) + ".tif")
+    return stack_images(image_paths, output_path, tile_size, radius, workers)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Focus stack the frames of one or more stack folders")
+    parser.add_argument("folders", nargs="+")
+    parser.add_argument("--output", help="Output image, only valid with a single folder")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--tile-size", type=int, default=TILE_SIZE)
+    parser.add_argument("--radius", type=int, default=FOCUS_RADIUS)
+    args = parser.parse_args()
+    for folder in args.folders:
+        stack_folder(folder, args.output if len(args.folders) == 1 else None, args.tile_size, args.radius, args.workers)
@@ -49,10 +49,13 @@ void loop() {
             } else if (command == 'D') {
                 stepper.rotate(-value);
             }
+            Serial.println("OK"); // Acknowledge once the move has completed
         } else if (command == 'R') {
             digitalWrite(ENABLE_PIN, HIGH);
         } else if (command == 'A') {
             digitalWrite(ENABLE_PIN, LOW);
+        } else if (command == 'I') {
+            Serial.println("MICROSTACKING"); // Lets the host tell this board from other serial devices
         }
     }
 }
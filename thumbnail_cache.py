@@ -0,0 +1,120 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+from PIL import Image
+import io
+import os
+import sqlite3
+import threading
+from raw_preview import open_image
+from tracing import tracer
+
+THUMBNAIL_SIZE = (50, 50)
+THUMBNAIL_WORKERS = max(1, (os.cpu_count() or 2) - 1)  # Decoding processes, one core is left for the UI
+THUMBNAIL_QUALITY = 85  # JPEG quality of the stored thumbnails, a few kB each
+
+def make_thumbnail(image_path, size=THUMBNAIL_SIZE):
+    image = open_image(image_path, size)
+    image.draft("RGB", size)  # JPEG files can be decoded directly at a reduced scale
+    image.thumbnail(size)
+    return image.convert("RGB")
+
+def encode_thumbnail(thumbnail):
+    data = io.BytesIO()
+    thumbnail.convert("RGB").save(data, "JPEG", quality=THUMBNAIL_QUALITY)
+    return data.getvalue()
+
+def decode_thumbnail(data):
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image
+
+def thumbnail_data(image_path, size=THUMBNAIL_SIZE):
+    # Runs in a worker process and returns the JPEG the cache stores, so the parent does not encode it again
+    return encode_thumbnail(make_thumbnail(image_path, size))
+
+class ThumbnailCache:
+    # Thumbnails stored as JPEG in a single SQLite file, keyed by path and invalidated by size and mtime
+    def __init__(self, db_path, size=THUMBNAIL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # Losing the last writes of a cache is harmless
+        self.db.executescript(
+            "DROP TABLE IF EXISTS thumbnails;"  # Raw RGB rows of earlier versions
+            "CREATE TABLE IF NOT EXISTS jpeg_thumbnails ("
+            "path TEXT PRIMARY KEY, file_size INTEGER, mtime REAL, width INTEGER, height INTEGER, data BLOB)"
+        )
+        self.db.commit()
+        self.entries = None  # Stats read at once by load(), so misses at startup do not hit the database
+
+    def load(self):
+        # Only the stats are kept in memory, the image data is read when a row is shown
+        with self.lock:
+            rows = self.db.execute("SELECT path, file_size, mtime FROM jpeg_thumbnails").fetchall()
+        self.entries = {path: (file_size, mtime) for path, file_size, mtime in rows}
+
+    def get(self, image_path):
+        image_path = os.path.normpath(image_path)
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        if self.entries is not None and self.entries.get(image_path) != (stat.st_size, stat.st_mtime):
+            return None  # Not cached, or the file changed since the thumbnail was made
+        with self.lock:
+            row = self.db.execute(
+                "SELECT file_size, mtime, data FROM jpeg_thumbnails WHERE path = ?", (image_path,)
+            ).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime:
+            return None
+        return decode_thumbnail(row[2])
+
+    def put(self, image_path, thumbnail, data=None):
+        # data is the thumbnail already encoded, as thumbnail_data returns it
+        image_path = os.path.normpath(image_path)
+        stat = os.stat(image_path)
+        if data is None:
+            data = encode_thumbnail(thumbnail)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO jpeg_thumbnails VALUES (?, ?, ?, ?, ?, ?)",
+                (image_path, stat.st_size, stat.st_mtime, thumbnail.width, thumbnail.height, data),
+            )
+            self.db.commit()
+        if self.entries is not None:
+            self.entries[image_path] = (stat.st_size, stat.st_mtime)
+
+    def thumbnail(self, image_path):
+        thumbnail = self.get(image_path)
+        if thumbnail is None:
+            with tracer.span("thumbnail", file=os.path.basename(image_path)):
+                thumbnail = make_thumbnail(image_path, self.size)
+            self.put(image_path, thumbnail)
+        return thumbnail
+
+    def prune(self, image_paths):
+        # Forget thumbnails of files that are no longer in the library
+        keep = {os.path.normpath(image_path) for image_path in image_paths}
+        with self.lock:
+            stale = [(path,) for (path,) in self.db.execute("SELECT path FROM jpeg_thumbnails") if path not in keep]
+            self.db.executemany("DELETE FROM jpeg_thumbnails WHERE path = ?", stale)
+            self.db.commit()
+        if self.entries is not None:
+            for (path,) in stale:
+                self.entries.pop(path, None)
@@ -0,0 +1,103 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Span recorder for the phases of a frame's life (trigger, download, save, thumbnail, display, move, wait),
+# preview frames and config writes. Spans recorded during a stack run are tagged with it and can be
+# exported as a Chrome trace, which Perfetto and chrome://tracing open, and as a summary table.
+# Several runs can be in progress at once, one per rig: spans of the threads a run was started with belong
+# to that run only, spans of any other thread to every run in progress.
+
+from collections import deque
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import threading
+import time
+
+MAX_SPANS = 100000  # Oldest spans are dropped first, so a long preview session cannot grow memory
+
+class Tracer:
+    def __init__(self, max_spans=MAX_SPANS):
+        self.spans = deque(maxlen=max_spans)
+        self.lock = threading.Lock()
+        self.runs = {}  # Thread id -> run in progress on that thread
+        self.run_ids = itertools.count(1)
+
+    @contextmanager
+    def span(self, name, category="frame", **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, category, start, time.perf_counter(), args)
+
+    def record(self, name, category, start, end, args=None):
+        thread = threading.current_thread()
+        with self.lock:
+            run = self.runs.get(thread.ident)
+            runs = (run,) if run else tuple(set(self.runs.values()))
+            self.spans.append({"name": name, "cat": category, "start": start, "end": end, "tid": thread.ident, "thread": thread.name, "runs": runs, "args": args or {}})
+
+    def begin_run(self, name, threads=()):
+        # Returns the run to pass to end_run. Runs get a unique id, as a folder name may be reused.
+        run = (next(self.run_ids), name)
+        with self.lock:
+            for thread in (threading.current_thread(),) + tuple(threads):
+                self.runs[thread.ident] = run
+        return run
+
+    def end_run(self, run):
+        with self.lock:
+            self.runs = {thread: other for thread, other in self.runs.items() if other != run}
+            return [span for span in self.spans if run in span["runs"]]
+
+    def chrome_trace(self, spans):
+        pid = os.getpid()
+        events = []
+        for tid, thread in {span["tid"]: span["thread"] for span in spans}.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread}})
+        for span in spans:
+            events.append({
+                "name": span["name"], "cat": span["cat"], "ph": "X", "pid": pid, "tid": span["tid"],
+                "ts": span["start"] * 1e6, "dur": (span["end"] - span["start"]) * 1e6, "args": span["args"],
+            })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path, spans=None):
+        if spans is None:
+            with self.lock:
+                spans = list(self.spans)
+        with open(path, "w") as file:
+            json.dump(self.chrome_trace(spans), file)
+
+    def summary(self, spans):
+        phases = {}
+        for span in spans:
+            phases.setdefault((span["cat"], span["name"]), []).append((span["end"] - span["start"]) * 1000)
+        lines = [f"{'phase':<24}{'count':>7}{'total ms':>11}{'mean ms':>10}{'p50 ms':>9}{'p90 ms':>9}{'max ms':>9}"]
+        for (category, name), durations in sorted(phases.items(), key=lambda item: -sum(item[1])):
+            durations.sort()
+            p50 = durations[len(durations) // 2]
+            p90 = durations[min(len(durations) - 1, int(len(durations) * 0.9))]
+            lines.append(
+                f"{category + '/' + name:<24}{len(durations):>7}{sum(durations):>11.1f}"
+                f"{sum(durations) / len(durations):>10.1f}{p50:>9.1f}{p90:>9.1f}{durations[-1]:>9.1f}"
+            )
+        return "\n".join(lines)
+
+tracer = Tracer()
@@ -0,0 +1,352 @@
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright 2024 Julien Colafrancesco
+#
+
+# Zoom and pan over full-resolution frames. The first zoom on a frame builds a tiled pyramid in the
+# background, each level half the size of the previous one, stored as JPEG in SQLite next to the thumbnails.
+# Coarse levels are written first, so the view sharpens as the finer ones arrive. Rendering reads only the
+# tiles under the canvas at the level closest to the zoom, so its memory follows the canvas size.
+
+from PIL import Image
+import io
+import math
+import os
+import queue
+import sqlite3
+import threading
+import time
+from image_cache import RenditionCache
+from raw_preview import open_image
+from tracing import tracer
+
+TILE_SIZE = 256
+TILE_QUALITY = 90
+TILE_MEMORY_BYTES = 64 * 1024 * 1024  # Decoded tiles kept in memory
+PYRAMID_FRAMES = 8  # Frames whose pyramid is kept on disk (JPEG tiles, about a third more than the frame file), least recently viewed first out
+DRAFT_LEVELS = 3  # JPEG decoders scale down by up to 8 while decoding
+MAX_ZOOM = 8  # Display pixels per image pixel
+ZOOM_STEP = 1.25
+
+def level_size(size, level):
+    width, height = size
+    for _ in range(level):
+        width, height = (width + 1) // 2, (height + 1) // 2  # Same rounding as Image.reduce
+    return width, height
+
+class TileStore:
+    # Tiles are stored as JPEG. A pyramid records the finest level written so far, so it can be shown while
+    # the finer levels are still being built.
+    def __init__(self, db_path, max_frames=PYRAMID_FRAMES):
+        self.max_frames = max_frames
+        self.lock = threading.Lock()
+        self.memory = RenditionCache(TILE_MEMORY_BYTES)
+        self.building = set()  # Paths whose pyramid this process is building
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")  # Tiles can always be built again
+        self.db.executescript(
+            "DROP TABLE IF EXISTS pyramids;"  # Raw RGB tiles of earlier versions
+            "DROP TABLE IF EXISTS tiles;"
+            "CREATE TABLE IF NOT EXISTS jpeg_pyramids (path TEXT PRIMARY KEY, file_size INTEGER, mtime REAL,"
+            " width INTEGER, height INTEGER, levels INTEGER, ready INTEGER, used REAL);"
+            "CREATE TABLE IF NOT EXISTS jpeg_tiles (path TEXT, level INTEGER, x INTEGER, y INTEGER, data BLOB,"
+            " PRIMARY KEY (path, level, x, y));"
+        )
+        self.db.commit()
+
+    def pyramid(self, image_path):
+        # (width, height, levels, ready) of an up to date pyramid with at least one level written, ready being
+        # the finest one, or None. A pyramid left unfinished by an earlier run is built again.
+        image_path = os.path.normpath(image_path)
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        with self.lock:
+            row = self.db.execute(
+                "SELECT file_size, mtime, width, height, levels, ready FROM jpeg_pyramids WHERE path = ?", (image_path,)
+            ).fetchone()
+            if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime or row[5] >= row[4]:
+                return None
+            if row[5] > 0 and image_path not in self.building:
+                return None
+            self.db.execute("UPDATE jpeg_pyramids SET used = ? WHERE path = ?", (time.time(), image_path))
+            self.db.commit()
+        return row[2:]
+
+    def build(self, image_path, on_level=None):
+        # The coarse levels come first from a reduced decode, JPEG frames being scaled down while decoded, so
+        # the frame can be shown before it is decoded at full size. on_level is called as each level is written.
+        image_path = os.path.normpath(image_path)
+        stat = os.stat(image_path)
+        with self.lock:
+            self.building.add(image_path)
+        self.memory.forget(image_path)  # Tiles of an earlier version of the file
+        try:
+            with tracer.span("pyramid", category="ui", file=os.path.basename(image_path)):
+                image = open_image(image_path)
+                size = image.size
+                levels = 1
+                while max(level_size(size, levels - 1)) > TILE_SIZE:
+                    levels += 1
+                with self.lock:
+                    self.db.execute("DELETE FROM jpeg_tiles WHERE path = ?", (image_path,))
+                    self.db.execute(
+                        "INSERT OR REPLACE INTO jpeg_pyramids VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (image_path, stat.st_size, stat.st_mtime, size[0], size[1], levels, levels, time.time()),
+                    )
+                    paths = [path for (path,) in self.db.execute("SELECT path FROM jpeg_pyramids ORDER BY used DESC")]
+                    for path in paths[self.max_frames:]:
+                        if path not in self.building:
+                            self.db.execute("DELETE FROM jpeg_tiles WHERE path = ?", (path,))
+                            self.db.execute("DELETE FROM jpeg_pyramids WHERE path = ?", (path,))
+                    self.db.commit()
+                coarse_level = min(levels - 1, DRAFT_LEVELS)
+                image.draft("RGB", level_size(size, coarse_level))
+                image = image.convert("RGB")
+                first = next((level for level in range(coarse_level + 1) if level_size(size, level) == image.size), None)
+                if first is None:  # Scaled by the decoder to a size that is not a level
+                    image = image.resize(level_size(size, coarse_level), Image.BILINEAR)
+                    first = coarse_level
+                self.write_levels(image_path, image, first, levels, on_level)
+                if first > 0:
+                    image = open_image(image_path).convert("RGB")
+                    self.write_levels(image_path, image, 0, first, on_level)
+        except Exception:
+            with self.lock:
+                self.db.execute("DELETE FROM jpeg_tiles WHERE path = ?", (image_path,))
+                self.db.execute("DELETE FROM jpeg_pyramids WHERE path = ?", (image_path,))
+                self.db.commit()
+            raise
+        finally:
+            with self.lock:
+                self.building.discard(image_path)
+
+    def write_levels(self, image_path, image, first, end, on_level):
+        # Writes levels first to end - 1, image being level first, coarsest first. The reduced copies made
+        # first add a third to the memory of image, and each level is released once written.
+        images = [image]
+        while len(images) < end - first:
+            images.append(images[-1].reduce(2))  # Box filter, exact for halving
+        for level in reversed(range(first, end)):
+            image = images.pop()
+            for y in range(0, image.height, TILE_SIZE):  # Written a row of tiles at a time
+                rows = []
+                for x in range(0, image.width, TILE_SIZE):
+                    tile = image.crop((x, y, min(x + TILE_SIZE, image.width), min(y + TILE_SIZE, image.height)))
+                    data = io.BytesIO()
+                    tile.save(data, "JPEG", quality=TILE_QUALITY)
+                    rows.append((image_path, level, x // TILE_SIZE, y // TILE_SIZE, data.getvalue()))
+                with self.lock:
+                    self.db.executemany("INSERT OR REPLACE INTO jpeg_tiles VALUES (?, ?, ?, ?, ?)", rows)
+            with self.lock:
+                self.db.execute("UPDATE jpeg_pyramids SET ready = ? WHERE path = ?", (level, image_path))
+                self.db.commit()
+            if on_level:
+                on_level()
+
+    def tile(self, image_path, level, x, y):
+        image_path = os.path.normpath(image_path)
+        tile = self.memory.get(image_path, (level, x, y))
+        if tile is None:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT data FROM jpeg_tiles WHERE path = ? AND level = ? AND x = ? AND y = ?", (image_path, level, x, y)
+                ).fetchone()
+            if row is None:
+                return None
+            tile = Image.open(io.BytesIO(row[0]))
+            tile.load()
+            self.memory.put(image_path, (level, x, y), tile)
+        return tile
+
+class ZoomView:
+    # Wheel zooms around the pointer, dragging pans and a double click toggles between fit and 100%.
+    # While zoomed out to fit, the canvas is left to the application, which shows its own rendition.
+    def __init__(self, canvas, store, show, on_fit):
+        self.canvas = canvas
+        self.store = store
+        self.show = show  # Called with an image of the canvas size
+        self.on_fit = on_fit  # Called when the view returns to fit
+        self.image_path = None
+        self.size = None
+        self.levels = 0
+        self.ready = 0  # Finest level built so far
+        self.scale = None  # Display pixels per image pixel, None when fitted
+        self.center = (0, 0)  # Image coordinates shown at the middle of the canvas
+        self.drag_start = None
+        self.pending = False  # Zoom asked for before the tiles were ready
+        self.building = set()
+        self.built = queue.Queue()
+        canvas.bind("<MouseWheel>", lambda event: self.zoom(event, ZOOM_STEP if event.delta > 0 else 1 / ZOOM_STEP))
+        canvas.bind("<Button-4>", lambda event: self.zoom(event, ZOOM_STEP))  # X11 wheel up
+        canvas.bind("<Button-5>", lambda event: self.zoom(event, 1 / ZOOM_STEP))  # X11 wheel down
+        canvas.bind("<ButtonPress-1>", self.start_drag)
+        canvas.bind("<B1-Motion>", self.drag)
+        canvas.bind("<Double-Button-1>", self.toggle)
+        self.poll_builds()
+
+    @property
+    def active(self):
+        return self.scale is not None
+
+    def reset(self, image_path):
+        self.image_path = image_path
+        self.size = None
+        self.ready = 0
+        self.scale = None
+        self.pending = False
+
+    def canvas_size(self):
+        return self.canvas.winfo_width(), self.canvas.winfo_height()
+
+    def fit_scale(self):
+        width, height = self.canvas_size()
+        return min(width / self.size[0], height / self.size[1])
+
+    def load(self):
+        # True once a level of the current image's pyramid is available, starts building it otherwise
+        if self.size is not None:
+            return True
+        if self.refresh():
+            return True
+        if self.image_path not in self.building:
+            self.building.add(self.image_path)
+            threading.Thread(target=self.build, args=(self.image_path,), daemon=True).start()
+        return False
+
+    def refresh(self):
+        pyramid = self.store.pyramid(self.image_path)
+        if pyramid is None:
+            return False
+        self.size = pyramid[:2]
+        self.levels, self.ready = pyramid[2:]
+        return True
+
+    def build(self, image_path):
+        try:
+            self.store.build(image_path, lambda: self.built.put((image_path, False)))
+        except Exception as e:
+            print(f"Failed to build zoom tiles for {image_path}: {e}")
+        self.built.put((image_path, True))
+
+    def poll_builds(self):
+        # A level was written or the build is over
+        while not self.built.empty():
+            image_path, finished = self.built.get_nowait()
+            if finished:
+                self.building.discard(image_path)
+            if image_path != self.image_path:
+                continue
+            if self.refresh():
+                if self.pending:
+                    self.pending = False
+                    self.zoom_to(1.0)
+                elif self.active:
+                    self.render()  # Sharper now that a finer level is in
+            elif finished:
+                self.pending = False  # The build failed
+        self.canvas.after(50, self.poll_builds)
+
+    def zoom(self, event, factor):
+        if self.image_path is None or (not self.active and factor <= 1):
+            return  # Already fitted, no tiles needed to zoom out
+        if not self.load():
+            self.pending = True  # Zoomed to 100% once the tiles are ready
+            return
+        fit = self.fit_scale()
+        scale = (self.scale or fit) * factor
+        if scale <= fit:
+            self.fit()
+            return
+        scale = min(scale, MAX_ZOOM)
+        if self.scale is None:
+            self.center = (self.size[0] / 2, self.size[1] / 2)
+            old_scale = fit
+        else:
+            old_scale = self.scale
+        # Keep the image point under the pointer in place
+        width, height = self.canvas_size()
+        point_x = self.center[0] + (event.x - width / 2) / old_scale
+        point_y = self.center[1] + (event.y - height / 2) / old_scale
+        self.center = (point_x - (event.x - width / 2) / scale, point_y - (event.y - height / 2) / scale)
+        self.scale = scale
+        self.render()
+
+    def zoom_to(self, scale):
+        # Zooms around the middle of the image
+        if not self.load() or scale <= self.fit_scale():
+            return
+        self.center = (self.size[0] / 2, self.size[1] / 2)
+        self.scale = min(scale, MAX_ZOOM)
+        self.render()
+
+    def toggle(self, event):
+        if self.active:
+            self.fit()
+        elif self.image_path is not None:
+            if self.load():
+                self.zoom_to(1.0)
+            else:
+                self.pending = True
+
+    def fit(self):
+        self.scale = None
+        self.on_fit()
+
+    def start_drag(self, event):
+        self.drag_start = (event.x, event.y, self.center)
+
+    def drag(self, event):
+        if not self.active or self.drag_start is None or self.size is None:
+            return
+        x, y, (center_x, center_y) = self.drag_start
+        self.center = (center_x - (event.x - x) / self.scale, center_y - (event.y - y) / self.scale)
+        self.render()
+
+    def render(self):
+        if not self.active or self.image_path is None or not self.load():
+            return
+        width, height = self.canvas_size()
+        if width <= 0 or height <= 0:
+            return
+        self.center = (min(max(self.center[0], 0), self.size[0]), min(max(self.center[1], 0), self.size[1]))
+        # Coarsest level that still has at least one pixel per display pixel, or the finest built so far
+        level = min(self.levels - 1, max(self.ready, int(math.floor(math.log2(1 / self.scale)))))
+        factor = 2 ** level
+        level_width, level_height = level_size(self.size, level)
+        left = self.center[0] - width / 2 / self.scale
+        top = self.center[1] - height / 2 / self.scale
+        region_left = max(0, int(left / factor))
+        region_top = max(0, int(top / factor))
+        region_right = min(level_width, math.ceil((left + width / self.scale) / factor))
+        region_bottom = min(level_height, math.ceil((top + height / self.scale) / factor))
+        frame = Image.new("RGB", (width, height))
+        if region_right > region_left and region_bottom > region_top:
+            region = Image.new("RGB", (region_right - region_left, region_bottom - region_top))
+            for tile_y in range(region_top // TILE_SIZE, (region_bottom - 1) // TILE_SIZE + 1):
+                for tile_x in range(region_left // TILE_SIZE, (region_right - 1) // TILE_SIZE + 1):
+                    tile = self.store.tile(self.image_path, level, tile_x, tile_y)
+                    if tile is not None:
+                        region.paste(tile, (tile_x * TILE_SIZE - region_left, tile_y * TILE_SIZE - region_top))
+            zoom = self.scale * factor  # Display pixels per pixel of this level
+            # Pixels are shown as blocks when magnified, and filtered when reduced
+            region = region.resize(
+                (max(1, round(region.width * zoom)), max(1, round(region.height * zoom))),
+                Image.NEAREST if zoom >= 1 else Image.BILINEAR,
+            )
+            frame.paste(region, (round((region_left * factor - left) * self.scale), round((region_top * factor - top) * self.scale)))
+        self.show(frame)